@@ -0,0 +1,143 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Optional
+from cachetools import TTLCache
+from pymongo.errors import PyMongoError
+from config import settings
+import agent_repository
+from logging_config import get_logger
+
+logger = get_logger("agent_cache")
+
+_CACHED_FIELDS = set(agent_repository.AGENT_PROJECTION)
+
+
+class AgentCache:
+    """
+    Bounded in-process cache of agent configs.
+
+    Agents are effectively immutable, so entries live until their TTL expires.
+    Changes are picked up from a Mongo change stream when the deployment supports
+    one (replica set / Atlas); otherwise cached entries are revalidated against
+    the agent's `version` field at most every AGENT_CACHE_VERSION_CHECK_SECONDS.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int, version_check_seconds: int):
+        self._entries = TTLCache(maxsize=max_size, ttl=ttl_seconds)
+        self._version_check_seconds = version_check_seconds
+        self._watch_task: Optional[asyncio.Task] = None
+        self.change_stream_active = False
+        self.hits = 0
+        self.misses = 0
+        # Agents whose last_used_at was refreshed recently (bounds the writes)
+        self._touched = TTLCache(maxsize=max_size, ttl=settings.AGENT_TOUCH_INTERVAL_SECONDS)
+        self._touch_tasks = set()
+
+    async def get_agent(self, agent_id: str) -> Optional[dict]:
+        """Return the agent document (projected), or None if it doesn't exist"""
+        entry = self._entries.get(agent_id)
+        if entry is not None:
+            if self.change_stream_active or time.monotonic() - entry["checked_at"] < self._version_check_seconds:
+                self.hits += 1
+                self.record_use(agent_id)
+                return dict(entry["agent"])
+            if await self._still_current(agent_id, entry):
+                self.hits += 1
+                self.record_use(agent_id)
+                return dict(entry["agent"])
+
+        self.misses += 1
+        agent = await agent_repository.find_agent(agent_id)
+        if agent is None:
+            self._entries.pop(agent_id, None)
+            return None
+        self._entries[agent_id] = {"agent": agent, "checked_at": time.monotonic()}
+        self.record_use(agent_id)
+        return dict(agent)
+
+    def record_use(self, agent_id: str) -> None:
+        """
+        Refresh the agent's last_used_at (which keeps it from expiring) in the
+        background, at most once per AGENT_TOUCH_INTERVAL_SECONDS per agent.
+        """
+        if agent_id in self._touched:
+            return
+        self._touched[agent_id] = True
+        task = asyncio.create_task(self._touch(agent_id))
+        self._touch_tasks.add(task)
+        task.add_done_callback(self._touch_tasks.discard)
+
+    async def _touch(self, agent_id: str) -> None:
+        try:
+            await agent_repository.touch_agent(agent_id, datetime.now(timezone.utc))
+        except Exception as e:
+            self._touched.pop(agent_id, None)
+            logger.warning("Could not record agent use: %s", e, extra={"agent_id": agent_id})
+
+    async def _still_current(self, agent_id: str, entry: dict) -> bool:
+        """Cheap version check; a covered lookup instead of refetching the whole agent"""
+        version = await agent_repository.find_agent_version(agent_id)
+        if version is None or version != entry["agent"].get("version", 0):
+            self._entries.pop(agent_id, None)
+            return False
+        entry["checked_at"] = time.monotonic()
+        return True
+
+    def invalidate(self, agent_id: str) -> None:
+        self._entries.pop(agent_id, None)
+        self._touched.pop(agent_id, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def start(self) -> None:
+        """Start listening for agent changes (falls back to version checks if unsupported)"""
+        if self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch_changes())
+
+    async def stop(self) -> None:
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            await asyncio.gather(self._watch_task, return_exceptions=True)
+            self._watch_task = None
+
+    async def _watch_changes(self) -> None:
+        pipeline = [{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}]
+        try:
+            async with agent_repository.watch_agents(pipeline) as stream:
+                self.change_stream_active = True
+                async for change in stream:
+                    if self._affects_cached_fields(change):
+                        self.invalidate(str(change["documentKey"]["_id"]))
+        except PyMongoError as e:
+            logger.warning("Agent change stream unavailable, using version checks: %s", e)
+        finally:
+            # Without the stream we can't trust entries that skipped version checks
+            if self.change_stream_active:
+                self.change_stream_active = False
+                self.clear()
+
+    @staticmethod
+    def _affects_cached_fields(change: dict) -> bool:
+        if change["operationType"] != "update":
+            return True
+        description = change.get("updateDescription", {})
+        changed = set(description.get("updatedFields", {})) | set(description.get("removedFields", []))
+        # Dotted paths (e.g. "retrieval.chunk_count") belong to their top-level field
+        return any(field.split(".")[0] in _CACHED_FIELDS for field in changed)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "change_stream_active": self.change_stream_active,
+        }
+
+
+agent_cache = AgentCache(
+    settings.AGENT_CACHE_MAX_SIZE,
+    settings.AGENT_CACHE_TTL_SECONDS,
+    settings.AGENT_CACHE_VERSION_CHECK_SECONDS,
+)
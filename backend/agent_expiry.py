@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from bson import ObjectId
+from config import settings
+from db import agent_chunks_collection, question_pool_collection, conversations_collection
+import agent_repository
+from agent_cache import agent_cache
+from metrics import registry
+from logging_config import get_logger
+
+logger = get_logger("agent_expiry")
+
+agents_expired = registry.counter("agents_expired_total", "Agents removed after going unused for AGENT_TTL_SECONDS")
+
+
+async def _delete_dependents(agent_ids: List[ObjectId]) -> None:
+    """Remove what only the deleted agents used: chunk index, pooled questions, conversations"""
+    ids = [str(agent_id) for agent_id in agent_ids]
+    await agent_chunks_collection.delete_many({"agent_id": {"$in": agent_ids}})
+    await question_pool_collection.delete_many({"agent_id": {"$in": ids}})
+    await conversations_collection.delete_many({"agent_id": {"$in": ids}})
+    for agent_id in ids:
+        agent_cache.invalidate(agent_id)
+
+
+class AgentSweeper:
+    """
+    Periodically deletes agents that are not pinned and haven't been used for
+    AGENT_TTL_SECONDS, together with their dependent documents. A plain TTL index
+    would leave the chunk index and pooled questions behind, so this runs as a
+    sweep over the pinned_last_used_at index instead.
+    """
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None and settings.AGENT_TTL_SECONDS > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        try:
+            backfilled = await agent_repository.backfill_last_used_at(datetime.now(timezone.utc))
+            if backfilled:
+                logger.info("Started expiry clock for existing agents", extra={"agents": backfilled})
+        except Exception as e:
+            logger.warning("Agent last_used_at backfill failed: %s", e)
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.warning("Agent expiry sweep failed: %s", e)
+            await asyncio.sleep(settings.AGENT_SWEEP_SECONDS)
+
+    async def sweep(self) -> int:
+        """Delete every expired agent in batches of AGENT_SWEEP_BATCH; returns how many were removed"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=settings.AGENT_TTL_SECONDS)
+        removed = 0
+        while True:
+            candidates = await agent_repository.find_expired_agent_ids(cutoff, settings.AGENT_SWEEP_BATCH)
+            if not candidates:
+                break
+            # Agents used or pinned since the lookup survive the delete
+            deleted = await agent_repository.delete_expired_agents(candidates, cutoff)
+            if deleted:
+                await _delete_dependents(deleted)
+                agents_expired.inc(len(deleted))
+                removed += len(deleted)
+            if len(candidates) < settings.AGENT_SWEEP_BATCH or not deleted:
+                break
+        if removed:
+            logger.info("Expired unused agents", extra={"agents": removed})
+        return removed
+
+
+agent_sweeper = AgentSweeper()
@@ -0,0 +1,114 @@
+from datetime import datetime
+from typing import List, Optional
+from bson import ObjectId
+from db import agents_collection, migrations_collection
+from models import AgentConfig
+
+# Every agents query goes through this module with an explicit projection,
+# so the (potentially huge) knowledge_summary is only read where it is needed.
+
+# Only the fields the chat and question paths read
+AGENT_PROJECTION = {
+    "name": 1,
+    "system_prompt": 1,
+    "knowledge_summary": 1,
+    "retrieval": 1,
+    "version": 1,
+}
+# The fields of the public AgentConfig
+AGENT_CONFIG_PROJECTION = {
+    "name": 1,
+    "system_prompt": 1,
+    "knowledge_summary": 1,
+}
+
+
+def to_agent_config(agent_doc: dict) -> AgentConfig:
+    """Convert a MongoDB agent document into an AgentConfig model"""
+    # Convert ObjectId to string for the id field
+    agent_doc["id"] = str(agent_doc["_id"])
+    del agent_doc["_id"]  # Remove the original _id field
+    return AgentConfig(**agent_doc)
+
+
+async def find_agent(agent_id: str) -> Optional[dict]:
+    """The agent's chat/question fields, or None if it doesn't exist"""
+    return await agents_collection.find_one({"_id": ObjectId(agent_id)}, AGENT_PROJECTION)
+
+
+async def find_agent_version(agent_id: str) -> Optional[int]:
+    """Only the agent's version (None if it doesn't exist); answered from the _id index"""
+    agent = await agents_collection.find_one({"_id": ObjectId(agent_id)}, {"version": 1})
+    return agent.get("version", 0) if agent else None
+
+
+async def find_agent_config_by_hash(content_hash: str) -> Optional[AgentConfig]:
+    """The agent created from identical content (unique content_hash index), if any"""
+    agent = await agents_collection.find_one({"content_hash": content_hash}, AGENT_CONFIG_PROJECTION)
+    return to_agent_config(agent) if agent else None
+
+
+async def insert_agent(agent_doc: dict) -> None:
+    """Raises DuplicateKeyError if an agent with the same content_hash exists"""
+    await agents_collection.insert_one(agent_doc)
+
+
+async def mark_agent_unindexed(agent_id: ObjectId) -> None:
+    """Chat falls back to the knowledge summary for agents without a chunk index"""
+    await agents_collection.update_one({"_id": agent_id}, {"$unset": {"retrieval": ""}, "$inc": {"version": 1}})
+
+
+def watch_agents(pipeline: list):
+    """Change stream over the agents collection"""
+    return agents_collection.watch(pipeline)
+
+
+async def touch_agent(agent_id: str, now: datetime) -> None:
+    """Record that the agent was used; a single-field update by _id"""
+    await agents_collection.update_one({"_id": ObjectId(agent_id)}, {"$set": {"last_used_at": now}})
+
+
+async def set_agent_pinned(agent_id: str, pinned: bool) -> bool:
+    """Pinned agents never expire. Returns False if the agent doesn't exist."""
+    result = await agents_collection.update_one({"_id": ObjectId(agent_id)}, {"$set": {"pinned": pinned}})
+    return result.matched_count > 0
+
+
+def _expired(cutoff: datetime) -> dict:
+    return {"pinned": {"$ne": True}, "last_used_at": {"$lt": cutoff}}
+
+
+async def find_expired_agent_ids(cutoff: datetime, limit: int) -> List[ObjectId]:
+    """Unpinned agents last used before `cutoff` (pinned_last_used_at index, ids only)"""
+    agents = await agents_collection.find(_expired(cutoff), {"_id": 1}).limit(limit).to_list(length=limit)
+    return [agent["_id"] for agent in agents]
+
+
+async def delete_expired_agents(agent_ids: List[ObjectId], cutoff: datetime) -> List[ObjectId]:
+    """
+    Delete the given agents unless they were used or pinned meanwhile.
+    Returns the ids that were actually deleted.
+    """
+    await agents_collection.delete_many({"_id": {"$in": agent_ids}, **_expired(cutoff)})
+    survivors = await agents_collection.find({"_id": {"$in": agent_ids}}, {"_id": 1}).to_list(length=len(agent_ids))
+    kept = {agent["_id"] for agent in survivors}
+    return [agent_id for agent_id in agent_ids if agent_id not in kept]
+
+
+LAST_USED_AT_MIGRATION = "agents_last_used_at"
+
+
+async def backfill_last_used_at(now: datetime) -> int:
+    """
+    One-time migration: agents created before usage tracking start their expiry
+    clock now. The filter can't use an index, so a marker document makes later
+    starts skip it; new agents get last_used_at on insert.
+    """
+    if await migrations_collection.find_one({"_id": LAST_USED_AT_MIGRATION}, {"_id": 1}):
+        return 0
+    result = await agents_collection.update_many({"last_used_at": {"$exists": False}}, {"$set": {"last_used_at": now}})
+    # Idempotent, so instances starting at the same time may both run it
+    await migrations_collection.update_one(
+        {"_id": LAST_USED_AT_MIGRATION}, {"$setOnInsert": {"applied_at": now}}, upsert=True
+    )
+    return result.modified_count
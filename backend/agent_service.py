@@ -1,57 +1,150 @@
 from bson import ObjectId
-import google.generativeai as genai
-from typing import List
-from db import agents_collection
+import hashlib
+import json
+import unicodedata
+from datetime import datetime, timezone
+from typing import AsyncIterator, List, Optional
+from pymongo.errors import DuplicateKeyError
+import agent_repository
+from agent_cache import agent_cache
 from models import AgentConfig
+from llm_client import generate_text, stream_text
+from llm_scheduler import Priority
+from summarization_service import summarize_documents
+from retrieval_service import build_chunk_records, retrieval_stats, save_chunk_records, retrieve_relevant_chunks
+from model_router import Task, route_models
+from metrics import stage
+from prompt_builder import build_prompt, CHAT_TEMPLATE, CONVERSATION_TEMPLATE
 from config import settings
+from logging_config import get_logger
 
-# Configure the Gemini client (use environment variables in production)
-genai.configure(api_key=settings.GOOGLE_API_KEY)
-model = genai.GenerativeModel('gemini-1.5-flash')  # Updated model name
+logger = get_logger("agent_service")
 
-async def create_agent_from_docs(name: str, system_prompt: str, documents: List[str]) -> AgentConfig:
-    # 1. Combine all documents into a single text block
-    full_text = "\n\n".join(documents)
+
+def _normalize_text(text: str) -> str:
+    """Normalize unicode form, line endings and surrounding whitespace"""
+    text = unicodedata.normalize("NFC", text)
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    return "\n".join(line.rstrip() for line in text.strip().split("\n"))
+
+
+def compute_content_hash(name: str, system_prompt: str, documents: List[str]) -> str:
+    """
+    Hash the normalized (name, system_prompt, documents) tuple.
+    Agents with the same hash share the same knowledge summary.
+    """
+    payload = json.dumps(
+        [
+            _normalize_text(name),
+            _normalize_text(system_prompt),
+            [_normalize_text(doc) for doc in documents],
+        ],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+async def find_agent_by_content(content_hash: str) -> Optional[AgentConfig]:
+    """The agent already created from identical content, if any"""
+    return await agent_repository.find_agent_config_by_hash(content_hash)
+
+
+async def create_agent_from_docs(name: str, system_prompt: str, documents: List[str], use_cache: bool = True) -> AgentConfig:
+    # 1. Reuse an existing agent if the exact same content was already uploaded
+    content_hash = compute_content_hash(name, system_prompt, documents)
+    with stage("setup_agent", "dedup_lookup"):
+        existing_agent = await find_agent_by_content(content_hash)
+    if existing_agent:
+        # Reusing an agent counts as using it; keeps it from expiring
+        agent_cache.record_use(existing_agent.id)
+        return existing_agent
+
+    # 2. Chunk the raw documents for retrieval at chat time
+    agent_id = ObjectId()
+    with stage("setup_agent", "chunking"):
+        chunk_records = build_chunk_records(agent_id, documents)
     
-    # 2. Use Gemini to summarize the documents for the agent's knowledge base
-    prompt = f"Summarize the following information into a concise knowledge base: {full_text}"
-    summary_response = await model.generate_content_async(prompt)
+    # 3. Use Gemini to summarize the documents for the agent's knowledge base
+    # (large uploads are chunked and summarized with map-reduce)
+    with stage("setup_agent", "summarization"):
+        summary_text = await summarize_documents(route_models(Task.SUMMARIZATION), documents, use_cache=use_cache)
     
-    # 3. Create the agent configuration object
+    # 4. Create the agent configuration object
+    now = datetime.now(timezone.utc)
     agent_data = {
+        "_id": agent_id,
         "name": name,
         "system_prompt": system_prompt,
-        "knowledge_summary": summary_response.text
+        "knowledge_summary": summary_text,
+        "content_hash": content_hash,
+        "retrieval": retrieval_stats(chunk_records),
+        "version": 1,
+        "created_at": now,
+        "last_used_at": now
     }
     
-    # 4. Insert the new agent config into MongoDB
-    result = await agents_collection.insert_one(agent_data)
-    created_agent = await agents_collection.find_one({"_id": result.inserted_id})
+    # 5. Insert the new agent config and its chunk index into MongoDB.
+    # A concurrent identical upload may win the race; return its agent instead.
+    try:
+        await agent_repository.insert_agent(agent_data)
+    except DuplicateKeyError:
+        return await agent_repository.find_agent_config_by_hash(content_hash)
     
-    # 5. Convert the MongoDB document to an AgentConfig model
-    # Convert ObjectId to string for the id field
-    created_agent["id"] = str(created_agent["_id"])
-    del created_agent["_id"]  # Remove the original _id field
+    try:
+        with stage("setup_agent", "indexing"):
+            await save_chunk_records(chunk_records)
+    except Exception as e:
+        # Chat falls back to the knowledge summary when the agent has no index
+        logger.warning("Could not index documents: %s", e, extra={"agent_id": str(agent_id)})
+        await agent_repository.mark_agent_unindexed(agent_id)
     
-    return AgentConfig(**created_agent)
+    # 6. Convert the inserted document to an AgentConfig model (no need to read it back)
+    return agent_repository.to_agent_config(
+        {field: agent_data[field] for field in ("_id", *agent_repository.AGENT_CONFIG_PROJECTION)}
+    )
+
+async def build_chat_prompt(agent_config: dict, user_prompt: str, conversation: str = "") -> str:
+    # Only the most relevant excerpts go into the prompt; agents without an
+    # index (or questions that match nothing) fall back to the summary.
+    # Either way the knowledge is cut to the chat token budget.
+    excerpts = await retrieve_relevant_chunks(agent_config, user_prompt)
+    fields = {"system_prompt": agent_config['system_prompt'], "user_prompt": user_prompt}
+    if conversation:
+        # Multi-turn chat; the history comes out of the knowledge's share of the budget
+        fields["conversation"] = conversation
+    return build_prompt(
+        CONVERSATION_TEMPLATE if conversation else CHAT_TEMPLATE,
+        settings.CHAT_PROMPT_MAX_TOKENS,
+        excerpts or agent_config['knowledge_summary'],
+        **fields,
+    ).text
 
-async def get_agent_response(agent_id: str, user_prompt: str) -> str:
-    # 1. Find the agent's configuration in MongoDB
-    agent_config = await agents_collection.find_one({"_id": ObjectId(agent_id)})
+async def get_agent_response(agent_id: str, user_prompt: str, use_cache: bool = True) -> str:
+    # 1. Find the agent's configuration (in-process cache, MongoDB on a miss)
+    with stage("chat", "agent_lookup"):
+        agent_config = await agent_cache.get_agent(agent_id)
     if not agent_config:
         return None
 
     # 2. Construct the full prompt for Gemini
-    full_prompt = f"""
-    System Prompt: {agent_config['system_prompt']}
-
-    Knowledge Base: {agent_config['knowledge_summary']}
-    
-    User Question: {user_prompt}
-    
-    Answer:
-    """
+    with stage("chat", "prompt_build"):
+        full_prompt = await build_chat_prompt(agent_config, user_prompt)
     
     # 3. Get the response from Gemini
-    response = await model.generate_content_async(full_prompt)
-    return response.text
\ No newline at end of file
+    with stage("chat", "model_call"):
+        return await generate_text(route_models(Task.CHAT), full_prompt, use_cache=use_cache, priority=Priority.CHAT)
+
+async def stream_agent_response(agent_id: str, user_prompt: str, use_cache: bool = True) -> Optional[AsyncIterator[str]]:
+    """
+    Like get_agent_response, but returns an async iterator over response chunks.
+    Returns None if the agent does not exist, so callers can 404 before streaming.
+    """
+    with stage("chat_stream", "agent_lookup"):
+        agent_config = await agent_cache.get_agent(agent_id)
+    if not agent_config:
+        return None
+
+    with stage("chat_stream", "prompt_build"):
+        full_prompt = await build_chat_prompt(agent_config, user_prompt)
+    return stream_text(route_models(Task.CHAT), full_prompt, use_cache=use_cache, priority=Priority.CHAT)
@@ -0,0 +1,61 @@
+import re
+from typing import List
+
+# Rough average for Gemini tokenization of English/Spanish prose
+CHARS_PER_TOKEN = 4
+
+_PARAGRAPH_SPLIT = re.compile(r"\n\s*\n")
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?¿¡])\s+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate without calling the model's tokenizer"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _split_oversized(text: str, max_tokens: int) -> List[str]:
+    """Split a single paragraph that is larger than max_tokens on sentence, then word boundaries"""
+    pieces = []
+    current = ""
+    for sentence in _SENTENCE_SPLIT.split(text):
+        if estimate_tokens(sentence) > max_tokens:
+            # A single huge "sentence" (e.g. extracted tables); fall back to words
+            for word in sentence.split():
+                candidate = f"{current} {word}" if current else word
+                if current and estimate_tokens(candidate) > max_tokens:
+                    pieces.append(current)
+                    candidate = word
+                current = candidate
+            continue
+        candidate = f"{current} {sentence}" if current else sentence
+        if current and estimate_tokens(candidate) > max_tokens:
+            pieces.append(current)
+            candidate = sentence
+        current = candidate
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def split_into_chunks(documents: List[str], max_tokens: int) -> List[str]:
+    """
+    Split documents into chunks of at most ~max_tokens, packing whole paragraphs together.
+    Chunks never span two documents.
+    """
+    chunks = []
+    for document in documents:
+        current = ""
+        for paragraph in _PARAGRAPH_SPLIT.split(document):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            pieces = [paragraph] if estimate_tokens(paragraph) <= max_tokens else _split_oversized(paragraph, max_tokens)
+            for piece in pieces:
+                candidate = f"{current}\n\n{piece}" if current else piece
+                if current and estimate_tokens(candidate) > max_tokens:
+                    chunks.append(current)
+                    candidate = piece
+                current = candidate
+        if current:
+            chunks.append(current)
+    return chunks
@@ -8,14 +8,133 @@ class Settings:
     # API Keys
     GOOGLE_API_KEY: str = os.getenv("GOOGLE_API_KEY", "")
     
+    # Model
+    GEMINI_MODEL: str = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+    MODEL_WARMUP_ENABLED: bool = os.getenv("MODEL_WARMUP_ENABLED", "True").lower() == "true"
+    # Per-task models (default to GEMINI_MODEL) and an optional fallback model
+    MODEL_SUMMARIZATION: str = os.getenv("MODEL_SUMMARIZATION", GEMINI_MODEL)
+    MODEL_CHAT: str = os.getenv("MODEL_CHAT", GEMINI_MODEL)
+    MODEL_QUESTIONS: str = os.getenv("MODEL_QUESTIONS", GEMINI_MODEL)
+    MODEL_QUESTIONS_RETRY: str = os.getenv("MODEL_QUESTIONS_RETRY", MODEL_QUESTIONS)
+    MODEL_FALLBACK: str = os.getenv("MODEL_FALLBACK", "")
+    MODEL_SLOW_THRESHOLD_SECONDS: float = float(os.getenv("MODEL_SLOW_THRESHOLD_SECONDS", "15"))
+    MODEL_LATENCY_RECHECK_SECONDS: float = float(os.getenv("MODEL_LATENCY_RECHECK_SECONDS", "60"))
+    MODEL_LATENCY_EWMA_ALPHA: float = float(os.getenv("MODEL_LATENCY_EWMA_ALPHA", "0.2"))
+    
     # Database
     MONGODB_URI: str = os.getenv("MONGODB_URI", "mongodb://localhost:27017")
     DB_NAME: str = os.getenv("DB_NAME", "ai_agents_db")
+    MONGO_MAX_POOL_SIZE: int = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+    MONGO_MIN_POOL_SIZE: int = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+    MONGO_MAX_IDLE_TIME_MS: int = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "300000"))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS: int = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000"))
+    MONGO_SLOW_QUERY_MS: float = float(os.getenv("MONGO_SLOW_QUERY_MS", "100"))
+    MONGO_CHECK_QUERY_PLANS: bool = os.getenv("MONGO_CHECK_QUERY_PLANS", "True").lower() == "true"
     
     # App Settings
     APP_ENV: str = os.getenv("APP_ENV", "development")
     DEBUG: bool = os.getenv("DEBUG", "True").lower() == "true"
     
+    # Logging (LOG_FORMAT is "json" or "text"; payload sampling applies to raw model output)
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "DEBUG" if DEBUG else "INFO").upper()
+    LOG_FORMAT: str = os.getenv("LOG_FORMAT", "json").lower()
+    LOG_PAYLOAD_SAMPLE_RATE: float = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+    LOG_PAYLOAD_MAX_CHARS: int = int(os.getenv("LOG_PAYLOAD_MAX_CHARS", "500"))
+    
+    # LLM Response Cache
+    LLM_CACHE_ENABLED: bool = os.getenv("LLM_CACHE_ENABLED", "True").lower() == "true"
+    LLM_CACHE_MAX_SIZE: int = int(os.getenv("LLM_CACHE_MAX_SIZE", "1024"))
+    LLM_CACHE_TTL_SECONDS: int = int(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+    LLM_CACHE_MONGO_ENABLED: bool = os.getenv("LLM_CACHE_MONGO_ENABLED", "False").lower() == "true"
+    
+    # LLM Rate Limiting (0 disables a limit / deadline)
+    LLM_REQUESTS_PER_MINUTE: int = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "300"))
+    LLM_TOKENS_PER_MINUTE: int = int(os.getenv("LLM_TOKENS_PER_MINUTE", "1000000"))
+    LLM_MAX_CONCURRENT: int = int(os.getenv("LLM_MAX_CONCURRENT", "16"))
+    LLM_OUTPUT_TOKEN_ESTIMATE: int = int(os.getenv("LLM_OUTPUT_TOKEN_ESTIMATE", "1024"))
+    LLM_MAX_WAIT_CHAT_SECONDS: float = float(os.getenv("LLM_MAX_WAIT_CHAT_SECONDS", "10"))
+    LLM_MAX_WAIT_QUESTIONS_SECONDS: float = float(os.getenv("LLM_MAX_WAIT_QUESTIONS_SECONDS", "30"))
+    LLM_MAX_WAIT_SUMMARIZATION_SECONDS: float = float(os.getenv("LLM_MAX_WAIT_SUMMARIZATION_SECONDS", "60"))
+    LLM_MAX_WAIT_BACKGROUND_SECONDS: float = float(os.getenv("LLM_MAX_WAIT_BACKGROUND_SECONDS", "0"))
+    
+    # LLM Resilience
+    LLM_TIMEOUT_SECONDS: float = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+    LLM_MAX_RETRIES: int = int(os.getenv("LLM_MAX_RETRIES", "2"))
+    LLM_RETRY_BASE_DELAY_SECONDS: float = float(os.getenv("LLM_RETRY_BASE_DELAY_SECONDS", "0.5"))
+    LLM_RETRY_MAX_DELAY_SECONDS: float = float(os.getenv("LLM_RETRY_MAX_DELAY_SECONDS", "8"))
+    CIRCUIT_FAILURE_THRESHOLD: int = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+    CIRCUIT_RESET_SECONDS: float = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+    
+    # Document Summarization (map-reduce over chunks)
+    SUMMARY_CHUNK_TOKENS: int = int(os.getenv("SUMMARY_CHUNK_TOKENS", "6000"))
+    SUMMARY_REDUCE_FAN_IN: int = int(os.getenv("SUMMARY_REDUCE_FAN_IN", "8"))
+    SUMMARY_MAX_CONCURRENCY: int = int(os.getenv("SUMMARY_MAX_CONCURRENCY", "4"))
+    
+    # Retrieval (BM25 chunk index per agent)
+    RETRIEVAL_ENABLED: bool = os.getenv("RETRIEVAL_ENABLED", "True").lower() == "true"
+    RETRIEVAL_CHUNK_TOKENS: int = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "300"))
+    RETRIEVAL_TOP_K: int = int(os.getenv("RETRIEVAL_TOP_K", "4"))
+    # Upper bound on the chunks scored per query (only their term statistics are read)
+    RETRIEVAL_MAX_CANDIDATES: int = int(os.getenv("RETRIEVAL_MAX_CANDIDATES", "500"))
+    
+    # Prompt input budgets (estimated tokens); knowledge is trimmed to fit
+    CHAT_PROMPT_MAX_TOKENS: int = int(os.getenv("CHAT_PROMPT_MAX_TOKENS", "4000"))
+    QUESTION_PROMPT_MAX_TOKENS: int = int(os.getenv("QUESTION_PROMPT_MAX_TOKENS", "6000"))
+    
+    # Chat conversations: recent turns kept verbatim, older turns folded into a rolling summary
+    CHAT_HISTORY_MAX_TOKENS: int = int(os.getenv("CHAT_HISTORY_MAX_TOKENS", "1000"))
+    CHAT_SUMMARY_MAX_TOKENS: int = int(os.getenv("CHAT_SUMMARY_MAX_TOKENS", "300"))
+    CONVERSATION_SUMMARY_WORKERS: int = int(os.getenv("CONVERSATION_SUMMARY_WORKERS", "1"))
+    CONVERSATION_TTL_SECONDS: int = int(os.getenv("CONVERSATION_TTL_SECONDS", str(7 * 86400)))
+    
+    # Question Pool (pre-generated questions with background refill)
+    QUESTION_POOL_ENABLED: bool = os.getenv("QUESTION_POOL_ENABLED", "True").lower() == "true"
+    QUESTION_POOL_TARGET_SIZE: int = int(os.getenv("QUESTION_POOL_TARGET_SIZE", "20"))
+    QUESTION_POOL_LOW_WATER: int = int(os.getenv("QUESTION_POOL_LOW_WATER", "8"))
+    QUESTION_POOL_REFILL_BATCH: int = int(os.getenv("QUESTION_POOL_REFILL_BATCH", "10"))
+    QUESTION_POOL_WORKERS: int = int(os.getenv("QUESTION_POOL_WORKERS", "2"))
+    
+    # Question Generation (concurrent sub-batches)
+    QUESTION_BATCH_SIZE: int = int(os.getenv("QUESTION_BATCH_SIZE", "5"))
+    QUESTION_BATCH_CONCURRENCY: int = int(os.getenv("QUESTION_BATCH_CONCURRENCY", "4"))
+    QUESTION_BATCH_RETRIES: int = int(os.getenv("QUESTION_BATCH_RETRIES", "1"))
+    
+    # Agent Config Cache
+    AGENT_CACHE_MAX_SIZE: int = int(os.getenv("AGENT_CACHE_MAX_SIZE", "1000"))
+    AGENT_CACHE_TTL_SECONDS: int = int(os.getenv("AGENT_CACHE_TTL_SECONDS", "600"))
+    AGENT_CACHE_VERSION_CHECK_SECONDS: int = int(os.getenv("AGENT_CACHE_VERSION_CHECK_SECONDS", "30"))
+    
+    # Agent expiry: unpinned agents unused for AGENT_TTL_SECONDS are removed (0 disables)
+    AGENT_TTL_SECONDS: int = int(os.getenv("AGENT_TTL_SECONDS", str(7 * 86400)))
+    AGENT_TOUCH_INTERVAL_SECONDS: int = int(os.getenv("AGENT_TOUCH_INTERVAL_SECONDS", "3600"))
+    AGENT_SWEEP_SECONDS: float = float(os.getenv("AGENT_SWEEP_SECONDS", "3600"))
+    AGENT_SWEEP_BATCH: int = int(os.getenv("AGENT_SWEEP_BATCH", "500"))
+    
+    # Background agent setup jobs
+    SETUP_JOB_WORKERS: int = int(os.getenv("SETUP_JOB_WORKERS", "2"))
+    SETUP_JOB_MAX_ATTEMPTS: int = int(os.getenv("SETUP_JOB_MAX_ATTEMPTS", "3"))
+    SETUP_JOB_RETRY_DELAY_SECONDS: float = float(os.getenv("SETUP_JOB_RETRY_DELAY_SECONDS", "10"))
+    SETUP_JOB_LEASE_SECONDS: int = int(os.getenv("SETUP_JOB_LEASE_SECONDS", "120"))
+    SETUP_JOB_SWEEP_SECONDS: float = float(os.getenv("SETUP_JOB_SWEEP_SECONDS", "15"))
+    SETUP_JOB_RETENTION_SECONDS: int = int(os.getenv("SETUP_JOB_RETENTION_SECONDS", "86400"))
+    SETUP_JOB_POLL_SECONDS: float = float(os.getenv("SETUP_JOB_POLL_SECONDS", "1"))
+    # Uploaded documents are stored in parts of at most this many characters (well under 16MB in UTF-8)
+    SETUP_JOB_DOCUMENT_PART_CHARS: int = int(os.getenv("SETUP_JOB_DOCUMENT_PART_CHARS", "1000000"))
+    
+    # Document uploads (multipart) and server-side text extraction
+    UPLOAD_MAX_FILES: int = int(os.getenv("UPLOAD_MAX_FILES", "10"))
+    UPLOAD_MAX_FILE_BYTES: int = int(os.getenv("UPLOAD_MAX_FILE_BYTES", str(20 * 1024 * 1024)))
+    # Checked against Content-Length before the multipart body is parsed
+    UPLOAD_MAX_REQUEST_BYTES: int = int(os.getenv(
+        "UPLOAD_MAX_REQUEST_BYTES", str(UPLOAD_MAX_FILES * UPLOAD_MAX_FILE_BYTES + 1024 * 1024)
+    ))
+    UPLOAD_EXTRACT_WORKERS: int = int(os.getenv("UPLOAD_EXTRACT_WORKERS", "2"))
+    UPLOAD_EXTRACT_TIMEOUT_SECONDS: float = float(os.getenv("UPLOAD_EXTRACT_TIMEOUT_SECONDS", "60"))
+    
+    # Quiz sessions (answer keys kept server-side for grading)
+    QUIZ_SESSION_TTL_SECONDS: int = int(os.getenv("QUIZ_SESSION_TTL_SECONDS", "86400"))
+    QUIZ_MAX_ANSWERS: int = int(os.getenv("QUIZ_MAX_ANSWERS", "50"))
+    
     def validate_required_keys(self):
         """Validate that required API keys are present"""
         missing_keys = []
@@ -0,0 +1,232 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from bson import ObjectId
+from bson.errors import InvalidId
+from config import settings
+from db import conversations_collection
+from agent_cache import agent_cache
+from agent_service import build_chat_prompt
+from chunking import estimate_tokens
+from llm_client import generate_text
+from llm_scheduler import Priority
+from model_router import Task, route_models
+from prompt_builder import fit_knowledge
+from metrics import stage
+from logging_config import get_logger
+
+logger = get_logger("conversation_service")
+
+USER = "user"
+MODEL = "model"
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _object_id(conversation_id: str) -> Optional[ObjectId]:
+    try:
+        return ObjectId(conversation_id)
+    except InvalidId:
+        return None
+
+
+def _turn(role: str, text: str) -> dict:
+    return {"id": ObjectId(), "role": role, "text": text, "tokens": estimate_tokens(text), "at": _now()}
+
+
+def window_start(turns: List[dict], max_tokens: int) -> int:
+    """Index of the first turn of the most recent run of turns that fits into `max_tokens`"""
+    used = 0
+    for index in range(len(turns) - 1, -1, -1):
+        used += turns[index]["tokens"]
+        if used > max_tokens:
+            return index + 1
+    return 0
+
+
+def format_conversation(summary: str, turns: List[dict]) -> str:
+    """The conversation as it goes into the prompt: rolling summary, then the recent turns"""
+    parts = []
+    if summary:
+        parts.append(f"Summary of earlier messages: {summary}")
+    if turns:
+        parts.append("\n".join(f"{'User' if t['role'] == USER else 'Assistant'}: {t['text']}" for t in turns))
+    return "\n\n".join(parts)
+
+
+def _summary_prompt(summary: str, turns: List[dict]) -> str:
+    previous = f"Current summary: {summary}\n\n" if summary else ""
+    return (
+        "Update the summary of this conversation between a user and an assistant with the new messages. "
+        "Keep the facts, decisions and open questions later answers may depend on, "
+        f"in at most {settings.CHAT_SUMMARY_MAX_TOKENS * 3 // 4} words.\n\n"
+        f"{previous}New messages:\n{format_conversation('', turns)}"
+    )
+
+
+def _conversation_view(conversation: dict) -> dict:
+    """Public representation of a conversation document"""
+    return {
+        "conversation_id": str(conversation["_id"]),
+        "agent_id": conversation["agent_id"],
+        "summary": conversation.get("summary", ""),
+        "turns": [{"role": t["role"], "text": t["text"]} for t in conversation.get("turns", [])],
+        "created_at": conversation.get("created_at"),
+        "updated_at": conversation.get("updated_at"),
+    }
+
+
+async def create_conversation(agent_id: str) -> Optional[dict]:
+    """Start a conversation with an agent; returns None if the agent doesn't exist"""
+    if not await agent_cache.get_agent(agent_id):
+        return None
+    now = _now()
+    conversation = {
+        "_id": ObjectId(),
+        "agent_id": agent_id,
+        "summary": "",
+        "summary_version": 0,
+        "turns": [],
+        "created_at": now,
+        "updated_at": now,
+        "expires_at": now + timedelta(seconds=settings.CONVERSATION_TTL_SECONDS),
+    }
+    await conversations_collection.insert_one(conversation)
+    return _conversation_view(conversation)
+
+
+async def get_conversation(conversation_id: str) -> Optional[dict]:
+    """The conversation's summary and the turns not folded into it yet, or None if it doesn't exist"""
+    object_id = _object_id(conversation_id)
+    conversation = await conversations_collection.find_one({"_id": object_id}) if object_id else None
+    return _conversation_view(conversation) if conversation else None
+
+
+async def send_message(conversation_id: str, user_prompt: str, use_cache: bool = True) -> Optional[str]:
+    """
+    Answer a message in a conversation. The prompt carries the rolling summary and
+    the most recent turns that fit into CHAT_HISTORY_MAX_TOKENS, so its size doesn't
+    grow with the conversation. Returns None if the conversation or its agent doesn't exist.
+    """
+    # 1. Load the conversation and its agent
+    object_id = _object_id(conversation_id)
+    if object_id is None:
+        return None
+    with stage("conversation", "conversation_lookup"):
+        conversation = await conversations_collection.find_one({"_id": object_id}, {"agent_id": 1, "summary": 1, "turns": 1})
+    if not conversation:
+        return None
+    with stage("conversation", "agent_lookup"):
+        agent_config = await agent_cache.get_agent(conversation["agent_id"])
+    if not agent_config:
+        return None
+
+    # 2. Construct the prompt from the summary and the recent turns
+    turns = conversation["turns"]
+    with stage("conversation", "prompt_build"):
+        recent = turns[window_start(turns, settings.CHAT_HISTORY_MAX_TOKENS):]
+        full_prompt = await build_chat_prompt(
+            agent_config, user_prompt, format_conversation(conversation.get("summary", ""), recent)
+        )
+
+    # 3. Get the response from Gemini
+    with stage("conversation", "model_call"):
+        response = await generate_text(route_models(Task.CHAT), full_prompt, use_cache=use_cache, priority=Priority.CHAT)
+
+    # 4. Append both turns and keep the conversation alive
+    new_turns = [_turn(USER, user_prompt), _turn(MODEL, response)]
+    now = _now()
+    with stage("conversation", "history_write"):
+        await conversations_collection.update_one(
+            {"_id": object_id},
+            {
+                "$push": {"turns": {"$each": new_turns}},
+                "$set": {"updated_at": now,
+                         "expires_at": now + timedelta(seconds=settings.CONVERSATION_TTL_SECONDS)},
+            },
+        )
+
+    # 5. Turns that no longer fit the window are summarized in the background
+    if window_start(turns + new_turns, settings.CHAT_HISTORY_MAX_TOKENS) > 0:
+        conversation_summarizer.schedule(conversation_id)
+    return response
+
+
+class ConversationSummarizer:
+    """
+    Background workers that fold the turns that fell out of the history window
+    into the conversation's rolling summary, off the request path. Until a fold
+    finishes, those turns are simply left out of the prompt.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending = set()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, workers: int = None) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        for _ in range(workers or settings.CONVERSATION_SUMMARY_WORKERS):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pending.clear()
+
+    def schedule(self, conversation_id: str) -> None:
+        """Queue a fold for the conversation (no-op when not started or already queued)"""
+        if not self._tasks or conversation_id in self._pending:
+            return
+        self._pending.add(conversation_id)
+        self._queue.put_nowait(conversation_id)
+
+    async def _worker(self) -> None:
+        while True:
+            conversation_id = await self._queue.get()
+            try:
+                await self._fold(conversation_id)
+            except Exception as e:
+                logger.warning("Conversation summary failed: %s", e, extra={"conversation_id": conversation_id})
+            finally:
+                self._pending.discard(conversation_id)
+                self._queue.task_done()
+
+    async def _fold(self, conversation_id: str) -> None:
+        conversation = await conversations_collection.find_one(
+            {"_id": ObjectId(conversation_id)}, {"summary": 1, "summary_version": 1, "turns": 1}
+        )
+        if not conversation:
+            return
+        turns = conversation["turns"]
+        # Fold down to half the window so the next fold isn't due on the very next message
+        folded = turns[:window_start(turns, settings.CHAT_HISTORY_MAX_TOKENS // 2)]
+        if not folded:
+            return
+
+        summary = await generate_text(
+            route_models(Task.SUMMARIZATION), _summary_prompt(conversation.get("summary", ""), folded),
+            use_cache=False, priority=Priority.BACKGROUND
+        )
+        summary, _ = fit_knowledge(summary.strip(), settings.CHAT_SUMMARY_MAX_TOKENS)
+
+        # Turns appended meanwhile are kept; a concurrent fold (e.g. on another instance) wins
+        result = await conversations_collection.update_one(
+            {"_id": conversation["_id"], "summary_version": conversation.get("summary_version", 0)},
+            {
+                "$set": {"summary": summary},
+                "$inc": {"summary_version": 1},
+                "$pull": {"turns": {"id": {"$in": [t["id"] for t in folded]}}},
+            },
+        )
+        if not result.modified_count:
+            logger.debug("Conversation was summarized concurrently", extra={"conversation_id": conversation_id})
+
+
+conversation_summarizer = ConversationSummarizer()
@@ -1,10 +1,277 @@
+import asyncio
+import threading
 import motor.motor_asyncio
+from datetime import datetime, timezone
+from typing import List, Optional
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, monitoring
+from pymongo.errors import ConnectionFailure
 from pymongo.server_api import ServerApi
 from config import settings
+from metrics import registry
+from logging_config import get_logger
 
+logger = get_logger("db")
+
+slow_queries = registry.counter("mongo_slow_queries_total", "Mongo commands slower than MONGO_SLOW_QUERY_MS, by collection and command")
+collection_scans = registry.counter("mongo_collection_scans_total", "Query shapes whose plan is a collection scan, by collection")
+
+def query_shape(value):
+    """The structure of a filter with its values replaced, safe to log"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list) and value and isinstance(value[0], dict):
+        return [query_shape(item) for item in value]
+    return "?"
+
+
+def find_collection_scans(plan) -> bool:
+    """True if any stage of an explain plan is a collection scan"""
+    if isinstance(plan, dict):
+        return plan.get("stage") == "COLLSCAN" or any(find_collection_scans(v) for v in plan.values())
+    if isinstance(plan, list):
+        return any(find_collection_scans(item) for item in plan)
+    return False
+
+
+def explainable_query(command_name: str, command: dict) -> Optional[dict]:
+    """
+    The filter (and sort) a command selects documents with, as find arguments,
+    or None for commands that don't select documents (inserts, index builds...).
+    Updates, deletes and aggregations are explained as a find over the same filter,
+    which gets the same index choice; for bulk commands the first statement is used.
+    """
+    if command_name == "find":
+        query = {"filter": command.get("filter"), "sort": command.get("sort")}
+    elif command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes") or [{}]
+        query = {"filter": statements[0].get("q")}
+    elif command_name in ("count", "findAndModify"):
+        query = {"filter": command.get("query"), "sort": command.get("sort")}
+    elif command_name == "aggregate":
+        # count_documents is an aggregate starting with $match
+        pipeline = command.get("pipeline") or [{}]
+        if "$match" not in pipeline[0]:
+            return None
+        query = {"filter": pipeline[0]["$match"]}
+    else:
+        return None
+    return {name: value for name, value in query.items() if value}
+
+
+class SlowQueryListener(monitoring.CommandListener):
+    """
+    Logs Mongo commands slower than MONGO_SLOW_QUERY_MS. The first time the filter
+    shape of a slow find, count, aggregate, update or delete is seen it is explained
+    in the background, and a collection scan is logged as a warning, so a missing
+    index shows up before it hurts.
+    """
+
+    def __init__(self):
+        self._inflight = {}  # (collection, explainable query or None) by request
+        self._explained = set()
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self) -> None:
+        """Enable explaining slow finds on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+
+    def stop(self) -> None:
+        self._loop = None
+
+    def started(self, event):
+        # CRUD commands name their collection as the command's value
+        collection = event.command.get(event.command_name)
+        if isinstance(collection, str):
+            query = explainable_query(event.command_name, event.command)
+            with self._lock:
+                self._inflight[(event.connection_id, event.request_id)] = (collection, query)
+
+    def succeeded(self, event):
+        collection, query = self._pop(event)
+        elapsed_ms = event.duration_micros / 1000
+        if collection is None or elapsed_ms < settings.MONGO_SLOW_QUERY_MS:
+            return
+        slow_queries.inc(collection=collection, command=event.command_name)
+        logger.warning("Slow Mongo command", extra={
+            "collection": collection, "command": event.command_name, "duration_ms": round(elapsed_ms, 1),
+            "filter": query_shape(query.get("filter", {})) if query is not None else None,
+        })
+        if query is not None:
+            self._explain_once(collection, event.command_name, query)
+
+    def failed(self, event):
+        self._pop(event)
+
+    def _pop(self, event) -> tuple:
+        with self._lock:
+            return self._inflight.pop((event.connection_id, event.request_id), (None, None))
+
+    def _explain_once(self, collection: str, command_name: str, query: dict) -> None:
+        key = (collection, repr(query_shape(query.get("filter", {}))), repr(query.get("sort")))
+        with self._lock:
+            if key in self._explained or self._loop is None:
+                return
+            self._explained.add(key)
+        # Listeners may run on Motor's worker threads; the explain runs on the event loop
+        asyncio.run_coroutine_threadsafe(
+            check_query_plan(collection, f"slow {command_name} on {collection}", query), self._loop
+        )
+
+
+slow_query_listener = SlowQueryListener()
+
+# The client connects lazily; the app lifespan warms it up and closes it
 client = motor.motor_asyncio.AsyncIOMotorClient(
     settings.MONGODB_URI,
-    server_api=ServerApi("1")
+    server_api=ServerApi("1"),
+    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+    minPoolSize=settings.MONGO_MIN_POOL_SIZE,
+    maxIdleTimeMS=settings.MONGO_MAX_IDLE_TIME_MS,
+    serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    event_listeners=[slow_query_listener],
 )
 db = client[settings.DB_NAME]
-agents_collection = db.get_collection("agents")
\ No newline at end of file
+agents_collection = db.get_collection("agents")
+llm_cache_collection = db.get_collection("llm_cache")
+agent_chunks_collection = db.get_collection("agent_chunks")
+question_pool_collection = db.get_collection("question_pool")
+setup_jobs_collection = db.get_collection("setup_jobs")
+# Uploaded documents of setup jobs, split into parts so no single document nears Mongo's 16MB limit
+setup_job_documents_collection = db.get_collection("setup_job_documents")
+quiz_sessions_collection = db.get_collection("quiz_sessions")
+quiz_results_collection = db.get_collection("quiz_results")
+conversations_collection = db.get_collection("conversations")
+# One marker document per data migration that has been applied
+migrations_collection = db.get_collection("migrations")
+
+
+async def ping():
+    """Round trip to the server so the first request doesn't pay for connection setup"""
+    await client.admin.command("ping")
+
+
+def close():
+    client.close()
+
+
+# Every index the services rely on, by collection. Created at startup (idempotent).
+INDEXES = {
+    "agents": [
+        # Unique content hash so identical uploads resolve to a single agent.
+        # Partial filter keeps agents created before hashing existed out of the index.
+        IndexModel("content_hash", name="content_hash_unique", unique=True,
+                   partialFilterExpression={"content_hash": {"$type": "string"}}),
+        IndexModel([("created_at", DESCENDING)], name="created_at"),
+        # Expiry sweep: unpinned agents by last use
+        IndexModel([("pinned", ASCENDING), ("last_used_at", ASCENDING)], name="pinned_last_used_at"),
+    ],
+    # Shared LLM cache entries are removed by Mongo once they expire
+    "llm_cache": [
+        IndexModel("expires_at", name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    # Retrieval looks up an agent's chunks by the query terms they contain
+    "agent_chunks": [
+        IndexModel([("agent_id", ASCENDING), ("terms", ASCENDING)], name="agent_id_terms"),
+    ],
+    # Question pool: de-duplicate by question text, serve least-served first
+    "question_pool": [
+        IndexModel([("agent_id", ASCENDING), ("difficulty", ASCENDING), ("question_key", ASCENDING)],
+                   name="agent_difficulty_question_unique", unique=True),
+        IndexModel([("agent_id", ASCENDING), ("difficulty", ASCENDING), ("served_count", ASCENDING)],
+                   name="agent_difficulty_served_count"),
+    ],
+    # Setup jobs: the sweep looks for runnable jobs; finished jobs expire
+    "setup_jobs": [
+        IndexModel([("status", ASCENDING), ("available_at", ASCENDING)], name="status_available_at"),
+        IndexModel("expires_at", name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    # A job's document parts are loaded in order and removed when it finishes
+    "setup_job_documents": [
+        IndexModel([("job_id", ASCENDING), ("document", ASCENDING), ("part", ASCENDING)],
+                   name="job_document_part"),
+    ],
+    # Conversations expire after CONVERSATION_TTL_SECONDS without messages
+    "conversations": [
+        IndexModel("expires_at", name="expires_at_ttl", expireAfterSeconds=0),
+        # Removed with their agent when it expires
+        IndexModel("agent_id", name="agent_id"),
+    ],
+    # Quiz sessions expire; each question of a session is graded once; per-user XP history
+    "quiz_sessions": [
+        IndexModel("expires_at", name="expires_at_ttl", expireAfterSeconds=0),
+    ],
+    "quiz_results": [
+        IndexModel([("session_id", ASCENDING), ("question_id", ASCENDING)],
+                   name="session_question_unique", unique=True),
+        IndexModel([("user_id", ASCENDING), ("answered_at", DESCENDING)], name="user_id_answered_at"),
+    ],
+}
+
+
+def _query_shapes() -> List[tuple]:
+    """
+    (collection, description, find arguments) for the filters the services'
+    finds, counts, updates and deletes run, with sample values. Checked with
+    explain at startup so a query that would scan a whole collection is reported
+    before the collection is large.
+    """
+    some_id = ObjectId()
+    now = datetime.now(timezone.utc)
+    return [
+        ("agents", "agent by content hash", {"filter": {"content_hash": "0" * 64}}),
+        ("agents", "expired agents", {"filter": {"pinned": {"$ne": True}, "last_used_at": {"$lt": now}}}),
+        ("agent_chunks", "retrieval candidates", {"filter": {"agent_id": some_id, "terms": {"$in": ["x"]}}}),
+        ("agent_chunks", "chunks of expired agents", {"filter": {"agent_id": {"$in": [some_id]}}}),
+        ("question_pool", "pooled questions", {"filter": {"agent_id": "x", "difficulty": "any", "served_to": {"$ne": "u"}},
+                                               "sort": {"served_count": 1}}),
+        ("question_pool", "questions served to user", {"filter": {"agent_id": "x", "difficulty": "any",
+                                                                  "question_key": {"$in": ["k"]}, "served_to": "u"}}),
+        ("question_pool", "pooled duplicates to mark served", {"filter": {
+            "agent_id": "x", "difficulty": "any", "question_key": {"$in": ["k"]}, "served_to": {"$ne": "u"},
+        }}),
+        ("question_pool", "pooled questions of expired agents", {"filter": {"agent_id": {"$in": ["x"]}}}),
+        ("conversations", "conversations of expired agents", {"filter": {"agent_id": {"$in": ["x"]}}}),
+        ("question_pool", "fresh question count", {"filter": {"agent_id": "x", "difficulty": "any", "served_count": 0}}),
+        ("setup_jobs", "runnable jobs", {"filter": {"$or": [
+            {"status": "pending", "available_at": {"$lte": now}},
+            {"status": "running", "lease_expires_at": {"$lt": now}},
+        ]}}),
+        ("setup_job_documents", "job documents", {"filter": {"job_id": some_id}, "sort": {"document": 1, "part": 1}}),
+        ("quiz_results", "graded answer", {"filter": {"session_id": "x", "question_id": "q"}}),
+        ("quiz_results", "user XP history", {"filter": {"user_id": "u"}, "sort": {"answered_at": -1}}),
+    ]
+
+
+async def check_query_plan(collection: str, description: str, find: dict) -> bool:
+    """Explain a find with these arguments; logs a warning and returns True if it scans the whole collection"""
+    try:
+        explain = await db.command({"explain": {"find": collection, **find}, "verbosity": "queryPlanner"})
+    except ConnectionFailure:
+        raise
+    except Exception as e:
+        logger.debug("Could not explain query: %s", e, extra={"collection": collection, "query": description})
+        return False
+    if not find_collection_scans(explain.get("queryPlanner", {}).get("winningPlan")):
+        return False
+    collection_scans.inc(collection=collection)
+    logger.warning("Query scans the whole collection", extra={
+        "collection": collection, "query": description, "filter": query_shape(find.get("filter", {})),
+    })
+    return True
+
+
+async def check_query_plans() -> List[str]:
+    """Explain every declared query shape; returns the descriptions of those that scan a collection"""
+    scans = []
+    for collection, description, find in _query_shapes():
+        if await check_query_plan(collection, description, find):
+            scans.append(description)
+    return scans
+
+
+async def ensure_indexes():
+    """Create the declared indexes (idempotent; one round trip per collection)"""
+    for name, indexes in INDEXES.items():
+        await db.get_collection(name).create_indexes(indexes)
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, List, Optional, Set
+from fastapi import UploadFile
+from config import settings
+from logging_config import get_logger
+
+logger = get_logger("document_extraction")
+
+TEXT_EXTENSIONS = {".txt", ".md", ".markdown"}
+PDF_EXTENSIONS = {".pdf"}
+SUPPORTED_EXTENSIONS = TEXT_EXTENSIONS | PDF_EXTENSIONS
+COPY_CHUNK_BYTES = 1024 * 1024
+
+# Bounds the extraction processes running at once; each extraction gets its own process
+_process_slots: Optional[asyncio.Semaphore] = None
+_running: Set[ProcessPoolExecutor] = set()
+
+
+class DocumentUploadError(Exception):
+    """An uploaded file was rejected; `status_code` is the HTTP status to answer with"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _extension(filename: str) -> str:
+    return os.path.splitext(filename or "")[1].lower()
+
+
+def _too_large(filename: str) -> DocumentUploadError:
+    return DocumentUploadError(f"{filename} exceeds the {settings.UPLOAD_MAX_FILE_BYTES} byte limit", status_code=413)
+
+
+def extract_text(data: bytes, extension: str) -> str:
+    """Extract plain text from a text file's contents"""
+    if extension in TEXT_EXTENSIONS:
+        return data.decode("utf-8-sig", errors="replace")
+    raise ValueError(f"Unsupported file type: {extension}")
+
+
+def extract_pdf_text(path: str) -> str:
+    """
+    Extract plain text from a PDF on disk. Runs in a worker process, so this
+    must stay a module-level function with picklable arguments.
+    """
+    # Optional dependency; only needed when PDFs are uploaded
+    from pypdf import PdfReader
+    reader = PdfReader(path)
+    return "\n\n".join(page.extract_text() or "" for page in reader.pages)
+
+
+def _get_process_slots() -> asyncio.Semaphore:
+    global _process_slots
+    if _process_slots is None:
+        _process_slots = asyncio.Semaphore(settings.UPLOAD_EXTRACT_WORKERS)
+    return _process_slots
+
+
+def _kill(executor: ProcessPoolExecutor) -> None:
+    # No public API to stop a running task before Python 3.14 (terminate_workers)
+    for process in list((executor._processes or {}).values()):
+        process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def shutdown_extraction_pool() -> None:
+    """Kill the extractions still running (at shutdown)"""
+    global _process_slots
+    for executor in list(_running):
+        _kill(executor)
+    _running.clear()
+    _process_slots = None
+
+
+async def _run_in_process(fn, *args):
+    """
+    Run fn in a worker process of its own, killed if it exceeds the timeout (or the
+    request goes away). Only that process is killed, so a hung file doesn't fail
+    the extractions of other requests.
+    """
+    async with _get_process_slots():
+        executor = ProcessPoolExecutor(max_workers=1)
+        _running.add(executor)
+        future = asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+        try:
+            return await asyncio.wait_for(future, settings.UPLOAD_EXTRACT_TIMEOUT_SECONDS)
+        finally:
+            _running.discard(executor)
+            if future.cancelled():
+                # The task keeps running in its worker otherwise
+                _kill(executor)
+            else:
+                executor.shutdown(wait=False)
+
+
+def _copy_to_disk(source: BinaryIO, limit: int) -> Optional[str]:
+    """Copy an upload to a temporary file in chunks; None (and no file) if it exceeds limit bytes"""
+    copied = 0
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as target:
+        while chunk := source.read(COPY_CHUNK_BYTES):
+            copied += len(chunk)
+            if copied > limit:
+                break
+            target.write(chunk)
+    if copied > limit:
+        os.unlink(target.name)
+        return None
+    return target.name
+
+
+def check_request_size(content_length: Optional[str]) -> None:
+    """Reject an upload from its Content-Length header, before the body is read"""
+    if content_length is None:
+        raise DocumentUploadError("Content-Length is required for uploads.", status_code=411)
+    try:
+        length = int(content_length)
+    except ValueError:
+        raise DocumentUploadError("Invalid Content-Length header.")
+    if length > settings.UPLOAD_MAX_REQUEST_BYTES:
+        raise DocumentUploadError(
+            f"Upload exceeds the {settings.UPLOAD_MAX_REQUEST_BYTES} byte limit", status_code=413
+        )
+
+
+def _upload_size(upload: UploadFile) -> int:
+    if upload.size is not None:
+        return upload.size
+    upload.file.seek(0, os.SEEK_END)
+    return upload.file.tell()
+
+
+async def _extract_pdf(upload: UploadFile) -> str:
+    # The worker opens a copy on disk, so the PDF is never read into memory or pickled whole
+    path = await asyncio.to_thread(_copy_to_disk, upload.file, settings.UPLOAD_MAX_FILE_BYTES)
+    if path is None:
+        raise _too_large(upload.filename)
+    try:
+        return await _run_in_process(extract_pdf_text, path)
+    finally:
+        os.unlink(path)
+
+
+async def _extract(upload: UploadFile) -> str:
+    filename = upload.filename
+    extension = _extension(filename)
+    # Read from the file the multipart parser spooled, never more than the size limit
+    await upload.seek(0)
+    try:
+        if extension in PDF_EXTENSIONS:
+            text = await _extract_pdf(upload)
+        else:
+            data = await upload.read(settings.UPLOAD_MAX_FILE_BYTES + 1)
+            if len(data) > settings.UPLOAD_MAX_FILE_BYTES:
+                raise _too_large(filename)
+            text = await asyncio.to_thread(extract_text, data, extension)
+    except DocumentUploadError:
+        raise
+    except asyncio.TimeoutError:
+        raise DocumentUploadError(f"Timed out extracting text from {filename}", status_code=422)
+    except Exception as e:
+        logger.warning("Text extraction failed: %s", e, extra={"upload_filename": filename})
+        raise DocumentUploadError(f"Could not extract text from {filename}", status_code=422)
+    if not text.strip():
+        raise DocumentUploadError(f"No text found in {filename}", status_code=422)
+    return text
+
+
+async def extract_uploaded_documents(uploads: List[UploadFile]) -> List[str]:
+    """
+    Extract the text of uploaded files, in upload order. The uploads are read
+    from the files the multipart parser already spooled; each PDF is parsed in a
+    worker process of its own, which is killed if it exceeds the timeout.
+    """
+    if not uploads:
+        raise DocumentUploadError("No files provided.")
+    if len(uploads) > settings.UPLOAD_MAX_FILES:
+        raise DocumentUploadError(f"At most {settings.UPLOAD_MAX_FILES} files per upload.")
+    for upload in uploads:
+        if _extension(upload.filename) not in SUPPORTED_EXTENSIONS:
+            raise DocumentUploadError(
+                f"Unsupported file type: {upload.filename} (supported: {', '.join(sorted(SUPPORTED_EXTENSIONS))})",
+                status_code=415,
+            )
+        if _upload_size(upload) > settings.UPLOAD_MAX_FILE_BYTES:
+            raise _too_large(upload.filename)
+
+    return list(await asyncio.gather(*(_extract(upload) for upload in uploads)))
@@ -0,0 +1,25 @@
+from typing import Dict
+import google.generativeai as genai
+from config import settings
+
+# Configure the Gemini client once for the whole process
+genai.configure(api_key=settings.GOOGLE_API_KEY)
+
+_models: Dict[str, genai.GenerativeModel] = {}
+
+
+def get_model(name: str) -> genai.GenerativeModel:
+    """Shared client for a model name (created on first use)"""
+    model = _models.get(name)
+    if model is None:
+        model = _models[name] = genai.GenerativeModel(name)
+    return model
+
+
+# Default model client
+model = get_model(settings.GEMINI_MODEL)
+
+
+async def warm_up() -> None:
+    """Open the gRPC channel ahead of the first request (count_tokens is not billed)"""
+    await model.count_tokens_async("ping")
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import BulkWriteError
+from config import settings
+from db import quiz_sessions_collection, quiz_results_collection
+from models import Answer, Question
+from metrics import stage, answers_graded
+from logging_config import get_logger
+
+logger = get_logger("grading_service")
+
+
+async def create_quiz_session(agent_id: str, questions: List[Question], user_id: str = None) -> str:
+    """Store the answer key of a served quiz and return its session id"""
+    # Answers are graded by question id, so each id is stored once (the first one served wins)
+    unique = {}
+    for q in questions:
+        unique.setdefault(q.id, q)
+    now = datetime.now(timezone.utc)
+    session = {
+        "_id": ObjectId(),
+        "agent_id": agent_id,
+        "user_id": user_id,
+        "questions": [
+            {"id": q.id, "correctAnswer": q.correctAnswer, "explanation": q.explanation,
+             "xp": q.xp, "options": len(q.options)}
+            for q in unique.values()
+        ],
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=settings.QUIZ_SESSION_TTL_SECONDS),
+    }
+    await quiz_sessions_collection.insert_one(session)
+    return str(session["_id"])
+
+
+async def grade_answers(session_id: str, answers: List[Answer], user_id: str = None) -> Optional[dict]:
+    """
+    Grade a batch of answers for a quiz session and record them with one bulk write.
+
+    Correct answers earn the question's XP. Each question is recorded once per
+    session: a recorded answer is never overwritten, and resubmitting it earns no
+    XP and doesn't count towards `correct`/`total` again.
+    Returns None if the session doesn't exist (or expired); raises ValueError for
+    answers that don't match the session's questions.
+    """
+    # 1. Load the answer key (primary key lookup)
+    try:
+        object_id = ObjectId(session_id)
+    except InvalidId:
+        return None
+    with stage("grade", "session_lookup"):
+        session = await quiz_sessions_collection.find_one({"_id": object_id}, {"questions": 1, "user_id": 1, "agent_id": 1})
+    if not session:
+        return None
+
+    # 2. Grade against the stored questions
+    key = {q["id"]: q for q in session["questions"]}
+    if len({a.question_id for a in answers}) != len(answers):
+        raise ValueError("Each question can only be answered once per submission.")
+    user_id = user_id or session.get("user_id")
+    now = datetime.now(timezone.utc)
+    results = []
+    for answer in answers:
+        question = key.get(answer.question_id)
+        if question is None:
+            raise ValueError(f"Question {answer.question_id} is not part of this quiz.")
+        if not 0 <= answer.answer < question["options"]:
+            raise ValueError(f"Answer for {answer.question_id} is not a valid option.")
+        correct = answer.answer == question["correctAnswer"]
+        results.append({
+            "question_id": answer.question_id,
+            "correct": correct,
+            "correctAnswer": question["correctAnswer"],
+            "explanation": question["explanation"],
+            "xp_earned": question["xp"] if correct else 0,
+        })
+
+    # 3. Record every result in a single round trip. The unique (session, question)
+    # index rejects answers that were recorded before; those are left untouched.
+    docs = [{
+        "session_id": session_id,
+        "question_id": result["question_id"],
+        "agent_id": session.get("agent_id"),
+        "user_id": user_id,
+        "answer": answer.answer,
+        "correct": result["correct"],
+        "xp_earned": result["xp_earned"],
+        "answered_at": now,
+    } for answer, result in zip(answers, results)]
+    with stage("grade", "bulk_write"):
+        try:
+            await quiz_results_collection.insert_many(docs, ordered=False)
+            duplicates = set()
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+            duplicates = {error["index"] for error in e.details["writeErrors"]}
+
+    for index, result in enumerate(results):
+        if index in duplicates:
+            result["already_graded"] = True
+            result["xp_earned"] = 0
+            continue
+        answers_graded.inc(result="correct" if result["correct"] else "incorrect")
+
+    # Totals only count answers recorded by this submission
+    recorded = [r for r in results if not r.get("already_graded")]
+    logger.debug("Graded answers", extra={"session_id": session_id, "answers": len(results)})
+    return {
+        "session_id": session_id,
+        "results": results,
+        "correct": sum(1 for r in recorded if r["correct"]),
+        "total": len(recorded),
+        "xp_earned": sum(r["xp_earned"] for r in recorded),
+    }
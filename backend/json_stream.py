@@ -0,0 +1,75 @@
+import json
+from typing import Any, List
+
+
+class JSONArrayStreamParser:
+    """
+    Incrementally parse a streamed top-level JSON array of objects.
+
+    Text is fed as it arrives; every object is returned as soon as its closing
+    brace is seen. A malformed object is skipped without losing the others.
+    Anything before the opening '[' (e.g. a markdown fence) is ignored.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._pos = 0
+        self._in_array = False
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._object_start = None
+        self.errors = 0
+
+    def feed(self, text: str) -> List[Any]:
+        """Consume more text and return the objects completed by it"""
+        self._buffer += text
+        completed = []
+        while self._pos < len(self._buffer):
+            char = self._buffer[self._pos]
+            if not self._in_array:
+                if char == "[":
+                    self._in_array = True
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                if self._depth == 0 and char == "{":
+                    self._object_start = self._pos
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 0:
+                    # End of the top-level array; ignore anything after it
+                    self._in_array = False
+                else:
+                    self._depth -= 1
+                    if self._depth == 0 and self._object_start is not None:
+                        completed.extend(self._decode(self._buffer[self._object_start:self._pos + 1]))
+                        self._object_start = None
+            self._pos += 1
+
+        # Drop consumed text so memory stays bounded by the current object
+        keep_from = self._object_start if self._object_start is not None else self._pos
+        self._buffer = self._buffer[keep_from:]
+        self._pos -= keep_from
+        if self._object_start is not None:
+            self._object_start = 0
+        return completed
+
+    def _decode(self, raw: str) -> List[Any]:
+        try:
+            return [json.loads(raw)]
+        except json.JSONDecodeError:
+            self.errors += 1
+            return []
+
+
+def parse_json_array(text: str) -> List[Any]:
+    """Parse every complete object out of a (possibly truncated or fenced) JSON array"""
+    return JSONArrayStreamParser().feed(text)
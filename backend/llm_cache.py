@@ -0,0 +1,142 @@
+import hashlib
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from cachetools import TTLCache
+from config import settings
+from db import llm_cache_collection
+from logging_config import get_logger
+
+logger = get_logger("llm_cache")
+
+
+def make_cache_key(model_name: str, prompt: str) -> str:
+    """Build a cache key from the model name and a hash of the prompt"""
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return f"{model_name}:{prompt_hash}"
+
+
+class MemoryCacheBackend:
+    """In-process LRU tier with size and TTL limits"""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl_seconds)
+
+    async def get(self, key: str) -> Optional[str]:
+        return self._cache.get(key)
+
+    async def set(self, key: str, value: str) -> None:
+        self._cache[key] = value
+
+    async def delete(self, key: str) -> None:
+        self._cache.pop(key, None)
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
+class MongoCacheBackend:
+    """Shared tier so several workers can reuse the same responses"""
+
+    def __init__(self, collection, ttl_seconds: int):
+        self._collection = collection
+        self._ttl_seconds = ttl_seconds
+
+    async def get(self, key: str) -> Optional[str]:
+        # The TTL monitor only runs periodically, so filter expired entries too
+        entry = await self._collection.find_one(
+            {"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"response": 1},
+        )
+        return entry["response"] if entry else None
+
+    async def set(self, key: str, value: str) -> None:
+        now = datetime.now(timezone.utc)
+        await self._collection.update_one(
+            {"_id": key},
+            {"$set": {
+                "response": value,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self._ttl_seconds),
+            }},
+            upsert=True,
+        )
+
+    async def delete(self, key: str) -> None:
+        await self._collection.delete_one({"_id": key})
+
+    def clear(self) -> None:
+        # Shared entries expire on their own; nothing to clear locally
+        pass
+
+
+class LLMCache:
+    """
+    Tiered cache for model responses.
+    Tiers are checked in order; a hit in a later tier back-fills the earlier ones.
+    """
+
+    def __init__(self, backends: List, enabled: bool = True):
+        self.backends = backends
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        for index, backend in enumerate(self.backends):
+            try:
+                value = await backend.get(key)
+            except Exception as e:
+                # A broken shared tier should never fail the request
+                logger.warning("LLM cache read failed (%s): %s", type(backend).__name__, e)
+                continue
+            if value is not None:
+                for earlier in self.backends[:index]:
+                    await earlier.set(key, value)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: str) -> None:
+        if not self.enabled:
+            return
+        for backend in self.backends:
+            try:
+                await backend.set(key, value)
+            except Exception as e:
+                logger.warning("LLM cache write failed (%s): %s", type(backend).__name__, e)
+
+    async def delete(self, key: str) -> None:
+        for backend in self.backends:
+            try:
+                await backend.delete(key)
+            except Exception as e:
+                logger.warning("LLM cache delete failed (%s): %s", type(backend).__name__, e)
+
+    def clear(self) -> None:
+        for backend in self.backends:
+            backend.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "tiers": [type(backend).__name__ for backend in self.backends],
+        }
+
+
+def _build_default_cache() -> LLMCache:
+    backends = [MemoryCacheBackend(settings.LLM_CACHE_MAX_SIZE, settings.LLM_CACHE_TTL_SECONDS)]
+    if settings.LLM_CACHE_MONGO_ENABLED:
+        backends.append(MongoCacheBackend(llm_cache_collection, settings.LLM_CACHE_TTL_SECONDS))
+    return LLMCache(backends, enabled=settings.LLM_CACHE_ENABLED)
+
+
+response_cache = _build_default_cache()
@@ -0,0 +1,190 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator
+from chunking import estimate_tokens
+from config import settings
+from llm_cache import response_cache, make_cache_key
+from metrics import llm_call_duration, llm_tokens
+from llm_scheduler import Priority, llm_scheduler, max_wait_for
+from resilience import CircuitOpenError, call_with_retries, is_retryable
+from model_router import model_router
+from single_flight import SingleFlight
+from logging_config import get_logger
+
+logger = get_logger("llm_client")
+
+# Identical prompts issued concurrently share one upstream call
+inflight_calls = SingleFlight()
+
+
+def _model_name(model) -> str:
+    return str(getattr(model, "model_name", model))
+
+
+def _candidates(model) -> list:
+    """A single model or a list of models to try in order (see model_router.route_models)"""
+    return list(model) if isinstance(model, (list, tuple)) else [model]
+
+
+def _cache_key(model, prompt: str, generation_config: dict = None) -> str:
+    if generation_config:
+        # Same prompt with a different output schema/mode is a different request
+        prompt = f"{prompt}\n{json.dumps(generation_config, sort_keys=True, default=str)}"
+    # Routed calls are cached under the task's configured model, whichever model
+    # answered and however the router ordered the candidates
+    preferred = getattr(model, "preferred", None) if isinstance(model, list) else None
+    preferred = preferred or _model_name(_candidates(model)[0])
+    return make_cache_key(preferred, prompt)
+
+
+def _request_kwargs(generation_config: dict = None) -> dict:
+    return {"generation_config": generation_config} if generation_config else {}
+
+
+def _estimate_request_tokens(prompt: str) -> int:
+    return estimate_tokens(prompt) + settings.LLM_OUTPUT_TOKEN_ESTIMATE
+
+
+def _record_usage(response, estimated_tokens: int) -> None:
+    """Settle the token bucket with the real usage when the SDK reports it"""
+    usage = getattr(response, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", None)
+    if isinstance(total, int) and total > 0:
+        llm_scheduler.record_usage(estimated_tokens, total)
+    for kind, field in (("prompt", "prompt_token_count"), ("output", "candidates_token_count")):
+        count = getattr(usage, field, None)
+        if isinstance(count, int) and count > 0:
+            llm_tokens.inc(count, kind=kind)
+
+
+async def _call_with_fallback(candidates: list, call) -> object:
+    """
+    Run `call(model)` against each candidate until one succeeds. Only transient
+    failures (retries exhausted) and open circuits move on to the next model.
+    """
+    for index, candidate in enumerate(candidates):
+        name = _model_name(candidate)
+        started = time.perf_counter()
+        try:
+            response = await call_with_retries(lambda: call(candidate), model_router.breaker_for(name))
+        except Exception as e:
+            elapsed = time.perf_counter() - started
+            if not isinstance(e, CircuitOpenError):
+                llm_call_duration.observe(elapsed, model=name, outcome="error")
+                model_router.record(name, elapsed, ok=False)
+            if index == len(candidates) - 1 or not (isinstance(e, CircuitOpenError) or is_retryable(e)):
+                raise
+            logger.warning("Model %s unavailable, falling back to %s: %s", name, _model_name(candidates[index + 1]), e)
+            continue
+        elapsed = time.perf_counter() - started
+        llm_call_duration.observe(elapsed, model=name, outcome="success")
+        model_router.record(name, elapsed, ok=True)
+        return response
+
+
+async def generate_text(model, prompt: str, use_cache: bool = True, generation_config: dict = None,
+                        priority: Priority = Priority.QUESTIONS) -> str:
+    """
+    Call the model and return the response text, going through the response cache.
+    Concurrent identical calls are coalesced into one upstream request, which is
+    admitted by the global scheduler according to `priority`. Each attempt is bounded
+    by LLM_TIMEOUT_SECONDS and transient errors are retried behind the model's circuit
+    breaker. `model` may be a list of models, tried in order when one is unavailable.
+    Pass use_cache=False to force a fresh generation (the result is still stored).
+    """
+    candidates = _candidates(model)
+    key = _cache_key(model, prompt, generation_config)
+    estimated_tokens = _estimate_request_tokens(prompt)
+
+    async def attempt(candidate):
+        async with llm_scheduler.slot(priority, estimated_tokens, max_wait_for(priority)):
+            return await asyncio.wait_for(
+                candidate.generate_content_async(prompt, **_request_kwargs(generation_config)),
+                settings.LLM_TIMEOUT_SECONDS,
+            )
+
+    async def call_model() -> str:
+        response = await _call_with_fallback(candidates, attempt)
+        _record_usage(response, estimated_tokens)
+        text = response.text
+        await response_cache.set(key, text)
+        return text
+
+    if not use_cache:
+        # A forced fresh generation must not piggyback on someone else's call
+        return await call_model()
+
+    cached = await response_cache.get(key)
+    if cached is not None:
+        return cached
+    return await inflight_calls.do(key, call_model)
+
+
+async def forget_text(model, prompt: str, generation_config: dict = None) -> None:
+    """Drop a cached response, e.g. when it turned out to be unusable"""
+    await response_cache.delete(_cache_key(model, prompt, generation_config))
+
+
+async def stream_text(model, prompt: str, use_cache: bool = True, generation_config: dict = None,
+                      priority: Priority = Priority.CHAT) -> AsyncIterator[str]:
+    """
+    Yield the model response as it is generated.
+    A cached response is yielded in one piece; a complete fresh response is cached.
+    If the consumer stops early (e.g. client disconnect) the upstream stream is closed.
+    Fallback models (when `model` is a list) are only tried while opening the stream.
+    LLM_TIMEOUT_SECONDS applies to opening the stream and to every chunk after it,
+    so a stalled stream doesn't keep its scheduler slot.
+    """
+    candidates = _candidates(model)
+    key = _cache_key(model, prompt, generation_config)
+
+    if use_cache:
+        cached = await response_cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+
+    estimated_tokens = _estimate_request_tokens(prompt)
+    parts = []
+    async with llm_scheduler.slot(priority, estimated_tokens, max_wait_for(priority)):
+        # Only opening the stream (up to the first chunk) is retried; a stream that
+        # already produced output can't be replayed transparently
+        response = await _call_with_fallback(
+            candidates,
+            lambda candidate: asyncio.wait_for(
+                candidate.generate_content_async(prompt, stream=True, **_request_kwargs(generation_config)),
+                settings.LLM_TIMEOUT_SECONDS,
+            ),
+        )
+        chunks = aiter(response)
+        completed = False
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(anext(chunks), settings.LLM_TIMEOUT_SECONDS)
+                except StopAsyncIteration:
+                    break
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            completed = True
+        finally:
+            if not completed:
+                await _close_stream(response)
+    _record_usage(response, estimated_tokens)
+
+    if parts:
+        await response_cache.set(key, "".join(parts))
+
+
+async def _close_stream(response) -> None:
+    """Best-effort close of the underlying gRPC stream so we stop paying for tokens"""
+    iterator = getattr(response, "_iterator", None)
+    aclose = getattr(iterator, "aclose", None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception:
+        pass
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Optional
+from config import settings
+
+# Weight of the latest call in the moving average of how long calls hold a slot
+CALL_SECONDS_EWMA_ALPHA = 0.2
+
+
+class Priority(IntEnum):
+    """Lower value is served first"""
+    CHAT = 0
+    QUESTIONS = 1
+    SUMMARIZATION = 2
+    BACKGROUND = 3
+
+
+class LLMOverloadedError(Exception):
+    """Raised when a model call can't be admitted before its deadline"""
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Continuously refilling bucket; a limit of 0 or less means unlimited"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.capacity <= 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def seconds_until(self, amount: float, capped: bool = True) -> float:
+        """Time until `amount` can be taken (requests above capacity wait for a full bucket when capped)"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        if capped:
+            amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def consume(self, amount: float) -> None:
+        """Take tokens; may go negative so actual usage above the estimate is paid back"""
+        if self.unlimited:
+            return
+        self._refill()
+        self.tokens -= amount
+
+
+class _Waiter:
+    def __init__(self, priority: Priority, tokens: int, future: asyncio.Future):
+        self.priority = priority
+        self.tokens = tokens
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.abandoned = False
+
+
+class LLMScheduler:
+    """
+    Process-wide admission control for model calls.
+
+    Calls wait in a priority queue and are admitted when the request-per-minute
+    and token-per-minute buckets allow it and fewer than max_concurrent calls are
+    running. A call whose estimated wait exceeds its deadline is rejected up front;
+    the estimate covers the buckets and, from the moving average of call durations,
+    the wait for a free concurrency slot.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, max_concurrent: int):
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._max_concurrent = max_concurrent
+        self._in_flight = 0
+        self._call_seconds: Optional[float] = None
+        self._queue = []
+        self._sequence = itertools.count()
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+        self.granted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority, estimated_tokens: int, max_wait: Optional[float] = None):
+        """Hold a slot for the duration of one model call"""
+        await self._acquire(priority, estimated_tokens, max_wait)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._record_call(time.monotonic() - started)
+            self._release()
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int) -> None:
+        """Correct the token bucket once the real usage is known"""
+        self._tokens.consume(actual_tokens - estimated_tokens)
+
+    def estimate_wait(self, priority: Priority, tokens: int) -> float:
+        """Seconds until a new call at this priority could be admitted, given the queue ahead of it"""
+        ahead = [w for _, _, w in self._queue if not w.abandoned and w.priority <= priority]
+        return max(
+            self._requests.seconds_until(len(ahead) + 1, capped=False),
+            self._tokens.seconds_until(sum(w.tokens for w in ahead) + tokens, capped=False),
+            self._slot_wait(len(ahead)),
+        )
+
+    def _slot_wait(self, ahead: int) -> float:
+        """Expected wait for a concurrency slot: the calls that must finish first, max_concurrent at a time"""
+        excess = self._in_flight + ahead + 1 - self._max_concurrent
+        if excess <= 0 or self._call_seconds is None:
+            return 0.0
+        return excess / self._max_concurrent * self._call_seconds
+
+    def _record_call(self, seconds: float) -> None:
+        if self._call_seconds is None:
+            self._call_seconds = seconds
+        else:
+            self._call_seconds += CALL_SECONDS_EWMA_ALPHA * (seconds - self._call_seconds)
+
+    async def _acquire(self, priority: Priority, tokens: int, max_wait: Optional[float]) -> None:
+        if max_wait is not None:
+            expected = self.estimate_wait(priority, tokens)
+            if expected > max_wait:
+                self.rejected += 1
+                raise LLMOverloadedError(
+                    f"Model capacity exhausted (estimated wait {expected:.1f}s > {max_wait:.1f}s)",
+                    retry_after=expected,
+                )
+
+        waiter = _Waiter(priority, tokens, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._queue, (int(priority), next(self._sequence), waiter))
+        self._pump()
+
+        try:
+            await asyncio.wait({waiter.future}, timeout=max_wait)
+        except asyncio.CancelledError:
+            if waiter.future.done():
+                self._release()
+            waiter.abandoned = True
+            raise
+
+        if not waiter.future.done():
+            waiter.abandoned = True
+            self.rejected += 1
+            self._pump()
+            raise LLMOverloadedError(f"Timed out after {max_wait:.1f}s waiting for model capacity")
+
+    def _release(self) -> None:
+        self._in_flight -= 1
+        self._pump()
+
+    def _pump(self) -> None:
+        """Admit queued calls in priority order while limits allow"""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+
+        while self._queue:
+            _, _, waiter = self._queue[0]
+            if waiter.abandoned:
+                heapq.heappop(self._queue)
+                continue
+            if self._in_flight >= self._max_concurrent:
+                return  # the next release pumps again
+            delay = max(self._requests.seconds_until(1), self._tokens.seconds_until(waiter.tokens))
+            if delay > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(delay, self._pump)
+                return
+
+            heapq.heappop(self._queue)
+            self._requests.consume(1)
+            self._tokens.consume(waiter.tokens)
+            self._in_flight += 1
+            waited = time.monotonic() - waiter.enqueued_at
+            self.granted += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            waiter.future.set_result(None)
+
+    def stats(self) -> dict:
+        queued = [w for _, _, w in self._queue if not w.abandoned]
+        return {
+            "queue_depth": len(queued),
+            "queue_depth_by_priority": {
+                p.name.lower(): sum(1 for w in queued if w.priority == p) for p in Priority
+            },
+            "in_flight": self._in_flight,
+            "granted": self.granted,
+            "rejected": self.rejected,
+            "avg_wait_seconds": self.total_wait / self.granted if self.granted else 0.0,
+            "max_wait_seconds": self.max_wait,
+            "avg_call_seconds": self._call_seconds or 0.0,
+        }
+
+
+def max_wait_for(priority: Priority) -> Optional[float]:
+    """Admission deadline for a priority class (None means wait indefinitely)"""
+    seconds = {
+        Priority.CHAT: settings.LLM_MAX_WAIT_CHAT_SECONDS,
+        Priority.QUESTIONS: settings.LLM_MAX_WAIT_QUESTIONS_SECONDS,
+        Priority.SUMMARIZATION: settings.LLM_MAX_WAIT_SUMMARIZATION_SECONDS,
+        Priority.BACKGROUND: settings.LLM_MAX_WAIT_BACKGROUND_SECONDS,
+    }[priority]
+    return seconds if seconds > 0 else None
+
+
+llm_scheduler = LLMScheduler(
+    settings.LLM_REQUESTS_PER_MINUTE,
+    settings.LLM_TOKENS_PER_MINUTE,
+    settings.LLM_MAX_CONCURRENT,
+)
@@ -1,6 +1,126 @@
-from fastapi import FastAPI
+import time
+import uuid
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
 from router import router
+import db
+import gemini_client
+import metrics
+from config import settings
+from question_service import pool_refiller
+from agent_cache import agent_cache
+from setup_jobs import setup_job_runner
+from conversation_service import conversation_summarizer
+from agent_expiry import agent_sweeper
+from document_extraction import shutdown_extraction_pool
+from llm_cache import response_cache
+from llm_client import inflight_calls
+from llm_scheduler import llm_scheduler
+from model_router import model_router
+from logging_config import configure_logging, shutdown_logging, get_logger, request_id_var
 
-app = FastAPI(title="Scalable AI Agent")
+logger = get_logger("main")
 
-app.include_router(router, tags=["Agent"], prefix="/api")
\ No newline at end of file
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()
+
+    # Startup: warm connections so the first request after a deploy isn't a cold start.
+    # Failures are logged rather than fatal; requests will surface real outages.
+    try:
+        await db.ping()
+        await db.ensure_indexes()
+        if settings.MONGO_CHECK_QUERY_PLANS:
+            await db.check_query_plans()
+    except Exception as e:
+        logger.warning("MongoDB warm-up failed: %s", e)
+    db.slow_query_listener.start()
+
+    if settings.MODEL_WARMUP_ENABLED:
+        try:
+            await gemini_client.warm_up()
+        except Exception as e:
+            logger.warning("Gemini warm-up failed: %s", e)
+
+    pool_refiller.start()
+    agent_cache.start()
+    setup_job_runner.start()
+    conversation_summarizer.start()
+    agent_sweeper.start()
+
+    yield
+
+    # Shutdown: stop background workers before closing the clients they use
+    await agent_sweeper.stop()
+    await conversation_summarizer.stop()
+    await setup_job_runner.stop()
+    await pool_refiller.stop()
+    await agent_cache.stop()
+    shutdown_extraction_pool()
+    db.slow_query_listener.stop()
+    db.close()
+    shutdown_logging()
+
+
+app = FastAPI(title="Scalable AI Agent", lifespan=lifespan)
+
+app.include_router(router, tags=["Agent"], prefix="/api")
+
+
+@app.middleware("http")
+async def assign_request_id(request: Request, call_next):
+    """Tag every log line of a request with its id (taken from X-Request-ID when the caller sends one)"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    metrics.http_in_flight.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.http_in_flight.dec()
+        # Label by route template, not raw path, to keep agent ids out of the label set
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        metrics.http_request_duration.observe(time.perf_counter() - started, method=request.method, route=path)
+        metrics.http_requests.inc(method=request.method, route=path, status=status)
+
+
+def _collect_component_metrics() -> None:
+    """Copy counters kept by the caches, scheduler and breaker into the registry"""
+    llm = response_cache.stats()
+    metrics.llm_cache_lookups.set_total(llm["hits"], result="hit")
+    metrics.llm_cache_lookups.set_total(llm["misses"], result="miss")
+    agents = agent_cache.stats()
+    metrics.agent_cache_lookups.set_total(agents["hits"], result="hit")
+    metrics.agent_cache_lookups.set_total(agents["misses"], result="miss")
+    metrics.llm_coalesced.set_total(inflight_calls.stats()["coalesced"])
+    scheduler = llm_scheduler.stats()
+    metrics.llm_in_flight.set(scheduler["in_flight"])
+    for priority, depth in scheduler["queue_depth_by_priority"].items():
+        metrics.llm_queue_depth.set(depth, priority=priority)
+    for model_name, health in model_router.stats().items():
+        metrics.llm_circuit_open.set(0 if health["circuit"]["state"] == "closed" else 1, model=model_name)
+
+
+metrics.registry.add_collector(_collect_component_metrics)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
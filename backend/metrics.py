@@ -0,0 +1,189 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+from logging_config import get_logger
+
+logger = get_logger("metrics")
+
+# Latency buckets (seconds) spanning a cached lookup to a slow model call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: dict) -> LabelKey:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """Monotonically increasing value per label set"""
+    type = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels) -> None:
+        """Mirror a counter that is tracked elsewhere (refreshed by a collector)"""
+        self._values[_label_key(labels)] = value
+
+    def value(self, **labels) -> float:
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(key)} {_format_value(v)}" for key, v in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self.set_total(value, **labels)
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[LabelKey, dict] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def count(self, **labels) -> int:
+        series = self._series.get(_label_key(labels))
+        return series["count"] if series else 0
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, series in sorted(self._series.items()):
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Process-local metrics rendered in the Prometheus text exposition format.
+
+    Values that other components already track (cache hits, scheduler queue depth...)
+    are read at scrape time through collectors instead of being duplicated here.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._register(Counter(name, description))
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        return self._register(Gauge(name, description))
+
+    def histogram(self, name: str, description: str, buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, description, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """Register a callback that refreshes gauges right before each scrape"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_requests = registry.counter("http_requests_total", "HTTP requests by route and status")
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time until the response headers are sent, by route"
+)
+http_in_flight = registry.gauge("http_requests_in_flight", "HTTP requests currently being handled")
+
+stage_duration = registry.histogram(
+    "stage_duration_seconds", "Latency of each stage of a request (agent lookup, prompt build, model call, parsing...)"
+)
+
+llm_call_duration = registry.histogram("llm_call_duration_seconds", "Upstream model call latency by model and outcome")
+llm_tokens = registry.counter("llm_tokens_total", "Tokens reported by the model, by kind (prompt/output)")
+
+questions_served = registry.counter(
+    "questions_served_total", "Questions returned to clients by source (pool/generated/fallback)"
+)
+questions_invalid = registry.counter(
+    "questions_invalid_total", "Generated question objects dropped because they failed validation"
+)
+answers_graded = registry.counter("answers_graded_total", "Quiz answers graded server-side by result (correct/incorrect)")
+
+# Refreshed at scrape time by collectors registered in main.py
+llm_cache_lookups = registry.counter("llm_cache_lookups_total", "Response cache lookups by result (hit/miss)")
+agent_cache_lookups = registry.counter("agent_cache_lookups_total", "Agent config cache lookups by result (hit/miss)")
+llm_in_flight = registry.gauge("llm_in_flight", "Model calls currently holding a scheduler slot")
+llm_queue_depth = registry.gauge("llm_queue_depth", "Model calls waiting for admission, by priority")
+llm_coalesced = registry.counter("llm_coalesced_calls_total", "Model calls that joined an identical in-flight call")
+llm_circuit_open = registry.gauge("llm_circuit_open", "1 while a model's circuit breaker is open or half-open")
+
+
+@contextmanager
+def stage(operation: str, name: str):
+    """Time one stage of an operation, e.g. stage("generate_questions", "model_call")"""
+    with stage_duration.time(operation=operation, stage=name):
+        yield
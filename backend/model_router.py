@@ -0,0 +1,113 @@
+import time
+from enum import Enum
+from typing import Dict, List
+import gemini_client
+from config import settings
+from resilience import CircuitBreaker
+
+
+class Task(str, Enum):
+    SUMMARIZATION = "summarization"
+    CHAT = "chat"
+    QUESTIONS = "questions"
+    QUESTIONS_RETRY = "questions_retry"  # Re-asking after the first answer couldn't be parsed
+
+
+def _configured_model(task: Task) -> str:
+    return {
+        Task.SUMMARIZATION: settings.MODEL_SUMMARIZATION,
+        Task.CHAT: settings.MODEL_CHAT,
+        Task.QUESTIONS: settings.MODEL_QUESTIONS,
+        Task.QUESTIONS_RETRY: settings.MODEL_QUESTIONS_RETRY,
+    }[task]
+
+
+class _ModelHealth:
+    def __init__(self):
+        self.breaker = CircuitBreaker(settings.CIRCUIT_FAILURE_THRESHOLD, settings.CIRCUIT_RESET_SECONDS)
+        self.calls = 0
+        self.errors = 0
+        self.latency_ewma = None
+        self.last_sample_at = 0.0
+
+
+class ModelRouter:
+    """
+    Picks the model for each task from Settings and orders it against the fallback model.
+
+    Every model has its own circuit breaker and a moving average of its call latency.
+    The task's model goes first unless its circuit is open or it has become slower
+    than MODEL_SLOW_THRESHOLD_SECONDS; a slow model is still tried first every
+    MODEL_LATENCY_RECHECK_SECONDS so it can win its traffic back.
+    """
+
+    def __init__(self):
+        self._health: Dict[str, _ModelHealth] = {}
+
+    def _model_health(self, model_name: str) -> _ModelHealth:
+        health = self._health.get(model_name)
+        if health is None:
+            health = self._health[model_name] = _ModelHealth()
+        return health
+
+    def breaker_for(self, model_name: str) -> CircuitBreaker:
+        return self._model_health(model_name).breaker
+
+    def record(self, model_name: str, seconds: float, ok: bool) -> None:
+        health = self._model_health(model_name)
+        health.calls += 1
+        if not ok:
+            health.errors += 1
+            return
+        alpha = settings.MODEL_LATENCY_EWMA_ALPHA
+        health.latency_ewma = seconds if health.latency_ewma is None else alpha * seconds + (1 - alpha) * health.latency_ewma
+        health.last_sample_at = time.monotonic()
+
+    def _degraded(self, model_name: str) -> bool:
+        health = self._model_health(model_name)
+        if health.breaker.state == "open":
+            return True
+        threshold = settings.MODEL_SLOW_THRESHOLD_SECONDS
+        if threshold <= 0 or health.latency_ewma is None or health.latency_ewma <= threshold:
+            return False
+        # Let a probe through now and then so a recovered model gets traffic again
+        return time.monotonic() - health.last_sample_at < settings.MODEL_LATENCY_RECHECK_SECONDS
+
+    def model_names(self, task: Task) -> List[str]:
+        """Candidate model names for a task, best first"""
+        primary = _configured_model(task)
+        fallback = settings.MODEL_FALLBACK
+        if not fallback or fallback == primary:
+            return [primary]
+        if self._degraded(primary) and not self._degraded(fallback):
+            return [fallback, primary]
+        return [primary, fallback]
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "calls": health.calls,
+                "errors": health.errors,
+                "latency_ewma_seconds": health.latency_ewma,
+                "circuit": health.breaker.stats(),
+            }
+            for name, health in self._health.items()
+        }
+
+
+model_router = ModelRouter()
+
+
+class RoutedModels(list):
+    """Model clients to try, in order; `preferred` names the task's configured model"""
+
+    def __init__(self, models: list, preferred: str):
+        super().__init__(models)
+        self.preferred = preferred
+
+
+def route_models(task: Task) -> RoutedModels:
+    """Model clients to try for a task, in order (pass the list to llm_client)"""
+    models = [gemini_client.get_model(name) for name in model_router.model_names(task)]
+    # The configured model's client name, so keys match those written while it led the order
+    return RoutedModels(models, gemini_client.get_model(_configured_model(task)).model_name)
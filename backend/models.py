@@ -40,18 +40,53 @@ class AgentConfig(BaseModel):
     knowledge_summary: Optional[str] = None # A summary of the documents
 
 
-class Question(BaseModel):
+class PublicQuestion(BaseModel):
+    """A question as served to clients: no answer key, answers are graded server-side"""
     id: str
     type: Literal['multiple_choice', 'code_completion', 'debugging']
     question: str
     options: List[str]
-    correctAnswer: int  # Index of the correct answer in options array
-    explanation: str
     difficulty: Literal['beginner', 'intermediate', 'advanced']
     topic: str
     xp: int
 
 
+class Question(PublicQuestion):
+    correctAnswer: int  # Index of the correct answer in options array
+    explanation: str  # Revealed with the grading result
+
+    def public(self) -> dict:
+        return self.model_dump(include=set(PublicQuestion.model_fields))
+
+
+class Quiz(BaseModel):
+    agent: AgentConfig
+    questions: List[PublicQuestion]
+    session_id: str  # Submit the answers to /quiz/{session_id}/grade/
+
+
+class Answer(BaseModel):
+    question_id: str
+    answer: int  # Index of the chosen option
+
+
+class AnswerResult(BaseModel):
+    question_id: str
+    correct: bool
+    correctAnswer: int
+    explanation: str
+    xp_earned: int
+    already_graded: bool = False  # Answered before; the first answer stays recorded and no XP is awarded again
+
+
+class GradingResult(BaseModel):
+    session_id: str
+    results: List[AnswerResult]
+    correct: int
+    total: int
+    xp_earned: int
+
+
 class QuestionRequest(BaseModel):
     topic: str
     num_questions: int = Field(default=5, ge=1, le=20)
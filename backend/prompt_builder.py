@@ -0,0 +1,128 @@
+from string import Formatter
+from typing import List, NamedTuple, Tuple, Union
+from chunking import estimate_tokens, split_into_chunks
+from metrics import registry
+from logging_config import get_logger
+
+logger = get_logger("prompt_builder")
+
+KNOWLEDGE_SEPARATOR = "\n\n---\n\n"
+
+prompt_tokens = registry.histogram(
+    "prompt_tokens_estimated", "Estimated input tokens per built prompt, by template",
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768),
+)
+prompt_truncations = registry.counter(
+    "prompt_knowledge_truncated_total", "Prompts whose knowledge was cut to fit the token budget, by template"
+)
+
+
+class PromptTemplate:
+    """
+    A prompt whose static text is parsed and measured once, at import time.
+    Per request only the field values are counted.
+    """
+
+    def __init__(self, name: str, template: str):
+        self.name = name
+        self.template = template.strip() + "\n"
+        self.fields = {field for _, field, _, _ in Formatter().parse(self.template) if field}
+        self.static_tokens = estimate_tokens(self.template.format(**{field: "" for field in self.fields}))
+
+    def render(self, **fields) -> str:
+        return self.template.format(**fields)
+
+
+class BuiltPrompt(NamedTuple):
+    text: str
+    estimated_tokens: int
+    knowledge_tokens: int
+    truncated: bool
+
+
+def fit_knowledge(knowledge: Union[str, List[str]], budget_tokens: int) -> Tuple[str, bool]:
+    """
+    Fit knowledge into `budget_tokens`. A list of excerpts keeps whole excerpts in
+    order while they fit; a single text is cut at paragraph/sentence boundaries.
+    Returns the text and whether anything was dropped.
+    """
+    if budget_tokens <= 0:
+        return "", bool(knowledge)
+    if isinstance(knowledge, str):
+        if estimate_tokens(knowledge) <= budget_tokens:
+            return knowledge, False
+        head = split_into_chunks([knowledge], budget_tokens)
+        return (head[0] if head else ""), True
+
+    selected = []
+    used = 0
+    for excerpt in knowledge:
+        cost = estimate_tokens(excerpt) + (estimate_tokens(KNOWLEDGE_SEPARATOR) if selected else 0)
+        if used + cost > budget_tokens:
+            break
+        selected.append(excerpt)
+        used += cost
+    if not selected and knowledge:
+        # Not even the best excerpt fits whole; keep its beginning
+        return fit_knowledge(knowledge[0], budget_tokens)[0], True
+    return KNOWLEDGE_SEPARATOR.join(selected), len(selected) < len(knowledge)
+
+
+def build_prompt(template: PromptTemplate, budget_tokens: int, knowledge: Union[str, List[str]], **fields) -> BuiltPrompt:
+    """
+    Render `template`, giving the knowledge whatever is left of `budget_tokens`
+    after the static text and the other fields.
+    """
+    fixed_tokens = template.static_tokens + sum(estimate_tokens(str(value)) for value in fields.values())
+    knowledge_text, truncated = fit_knowledge(knowledge or "", budget_tokens - fixed_tokens)
+    text = template.render(knowledge=knowledge_text, **fields)
+
+    built = BuiltPrompt(text, estimate_tokens(text), estimate_tokens(knowledge_text), truncated)
+    prompt_tokens.observe(built.estimated_tokens, template=template.name)
+    if truncated:
+        prompt_truncations.inc(template=template.name)
+    logger.debug("Built prompt", extra={
+        "template": template.name, "estimated_tokens": built.estimated_tokens,
+        "knowledge_tokens": built.knowledge_tokens, "truncated": truncated,
+    })
+    return built
+
+
+CHAT_TEMPLATE = PromptTemplate("chat", """
+System Prompt: {system_prompt}
+
+Knowledge Base: {knowledge}
+
+User Question: {user_prompt}
+
+Answer:
+""")
+
+# Multi-turn chat: {conversation} is the rolling summary plus the recent turns,
+# both bounded, so the prompt stays the same size however long the conversation
+CONVERSATION_TEMPLATE = PromptTemplate("conversation", """
+System Prompt: {system_prompt}
+
+Knowledge Base: {knowledge}
+
+Conversation so far:
+{conversation}
+
+User Question: {user_prompt}
+
+Answer:
+""")
+
+# The output structure is enforced by JSON mode + response_schema, so the prompt
+# only states content rules instead of carrying a full JSON example
+QUESTION_TEMPLATE = PromptTemplate("questions", """
+Eres un experto en educación. Genera exactamente {num_questions} preguntas de opción múltiple en español{difficulty_filter} sobre "{topic}", basadas solo en este conocimiento:
+
+{knowledge}
+
+Reglas:
+- type "multiple_choice", 4 opciones realistas; correctAnswer = índice (0-3) de la correcta
+- Preguntas específicas al conocimiento, no genéricas; explanation justifica la respuesta
+- difficulty "{difficulty}", topic "{topic}", xp: beginner 80-100, intermediate 100-130, advanced 130-160
+{batch_instruction}
+""")
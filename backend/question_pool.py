@@ -0,0 +1,184 @@
+import asyncio
+import hashlib
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, List, Optional
+from pymongo.errors import BulkWriteError
+from config import settings
+from db import question_pool_collection
+from models import Question
+from logging_config import get_logger
+
+logger = get_logger("question_pool")
+
+
+def _pool_difficulty(difficulty: Optional[str]) -> str:
+    """Pool key for a difficulty filter (requests without one share the 'any' pool)"""
+    return difficulty or "any"
+
+
+def question_key(question: Question) -> str:
+    """Stable key used to de-duplicate questions by their text"""
+    normalized = " ".join(question.question.lower().split())
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+def pool_question_id(agent_id: str, question: Question) -> str:
+    """Question id that stays unique across generated batches"""
+    return f"agent-{agent_id}-{question_key(question)[:12]}"
+
+
+def _with_pool_ids(agent_id: str, questions: List[Question]) -> List[Question]:
+    return [
+        question.model_copy(update={"id": pool_question_id(agent_id, question)})
+        for question in questions
+    ]
+
+
+async def take_pooled_questions(agent_id: str, difficulty: Optional[str], limit: int,
+                                user_id: Optional[str] = None) -> List[Question]:
+    """
+    Take up to `limit` questions from the pool, least-served first.
+    When a user_id is given, questions already served to that user are skipped.
+    """
+    query = {"agent_id": agent_id, "difficulty": _pool_difficulty(difficulty)}
+    if user_id:
+        query["served_to"] = {"$ne": user_id}
+
+    docs = await question_pool_collection.find(query, {"question": 1}) \
+        .sort("served_count", 1).limit(limit).to_list(length=limit)
+    if not docs:
+        return []
+
+    update = {"$inc": {"served_count": 1}}
+    if user_id:
+        update["$addToSet"] = {"served_to": user_id}
+    await question_pool_collection.update_many({"_id": {"$in": [doc["_id"] for doc in docs]}}, update)
+
+    return [Question(**doc["question"]) for doc in docs]
+
+
+async def _store_questions(agent_id: str, difficulty: Optional[str], questions: List[Question],
+                           served_to: Optional[str] = None) -> int:
+    """Insert questions into the pool, skipping duplicates. Returns how many were new."""
+    if not questions:
+        return 0
+    now = datetime.now(timezone.utc)
+    docs = [{
+        "agent_id": agent_id,
+        "difficulty": _pool_difficulty(difficulty),
+        "question_key": question_key(question),
+        "question": question.model_dump(),
+        "served_count": 1 if served_to else 0,
+        "served_to": [served_to] if served_to else [],
+        "created_at": now,
+    } for question in questions]
+    try:
+        result = await question_pool_collection.insert_many(docs, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        return e.details.get("nInserted", 0)
+
+
+async def served_question_keys(agent_id: str, difficulty: Optional[str], keys: List[str], user_id: str) -> set:
+    """The subset of `keys` whose pooled questions were already served to the user"""
+    if not keys:
+        return set()
+    docs = await question_pool_collection.find(
+        {"agent_id": agent_id, "difficulty": _pool_difficulty(difficulty),
+         "question_key": {"$in": keys}, "served_to": user_id},
+        {"question_key": 1},
+    ).to_list(length=len(keys))
+    return {doc["question_key"] for doc in docs}
+
+
+async def add_pooled_questions(agent_id: str, difficulty: Optional[str], questions: List[Question],
+                               served_to: Optional[str] = None) -> List[Question]:
+    """
+    Store questions in the pool and return them with their pool ids.
+    With `served_to`, questions that user has already seen are dropped, and the
+    ones that were already pooled are marked as served to them.
+    """
+    pooled = _with_pool_ids(agent_id, questions)
+    if not served_to or not pooled:
+        await _store_questions(agent_id, difficulty, pooled)
+        return pooled
+
+    keys = [question_key(question) for question in pooled]
+    seen = await served_question_keys(agent_id, difficulty, keys, served_to)
+    pooled = [question for question, key in zip(pooled, keys) if key not in seen]
+    inserted = await _store_questions(agent_id, difficulty, pooled, served_to=served_to)
+    if inserted < len(pooled):
+        await question_pool_collection.update_many(
+            {"agent_id": agent_id, "difficulty": _pool_difficulty(difficulty),
+             "question_key": {"$in": keys}, "served_to": {"$ne": served_to}},
+            {"$inc": {"served_count": 1}, "$addToSet": {"served_to": served_to}},
+        )
+    return pooled
+
+
+async def count_fresh_questions(agent_id: str, difficulty: Optional[str]) -> int:
+    """Number of pooled questions that have never been served"""
+    return await question_pool_collection.count_documents(
+        {"agent_id": agent_id, "difficulty": _pool_difficulty(difficulty), "served_count": 0}
+    )
+
+
+class QuestionPoolRefiller:
+    """
+    Background workers that top up a pool when it drops below the low-water mark.
+    `refill_fn(agent_id, difficulty, batch_size)` generates a batch of new questions.
+    """
+
+    def __init__(self, refill_fn: Callable[[str, Optional[str], int], Awaitable[List[Question]]]):
+        self._refill_fn = refill_fn
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending = set()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, workers: int = None) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        for _ in range(workers or settings.QUESTION_POOL_WORKERS):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pending.clear()
+
+    async def schedule_if_low(self, agent_id: str, difficulty: Optional[str]) -> None:
+        """Queue a refill if the pool is below the low-water mark (no-op when not started)"""
+        if not self._tasks:
+            return
+        key = (agent_id, difficulty)
+        if key in self._pending:
+            return
+        if await count_fresh_questions(agent_id, difficulty) >= settings.QUESTION_POOL_LOW_WATER:
+            return
+        self._pending.add(key)
+        self._queue.put_nowait(key)
+
+    async def _worker(self) -> None:
+        while True:
+            agent_id, difficulty = await self._queue.get()
+            try:
+                await self._refill(agent_id, difficulty)
+            except Exception as e:
+                logger.warning("Question pool refill failed: %s", e, extra={"agent_id": agent_id, "difficulty": difficulty})
+            finally:
+                self._pending.discard((agent_id, difficulty))
+                self._queue.task_done()
+
+    async def _refill(self, agent_id: str, difficulty: Optional[str]) -> None:
+        fresh = await count_fresh_questions(agent_id, difficulty)
+        while fresh < settings.QUESTION_POOL_TARGET_SIZE:
+            batch_size = min(settings.QUESTION_POOL_REFILL_BATCH, settings.QUESTION_POOL_TARGET_SIZE - fresh)
+            questions = await self._refill_fn(agent_id, difficulty, batch_size)
+            inserted = await _store_questions(agent_id, difficulty, _with_pool_ids(agent_id, questions))
+            if not inserted:
+                # Model keeps returning questions we already have; try again later
+                break
+            fresh += inserted
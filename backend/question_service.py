@@ -1,23 +1,41 @@
-import google.generativeai as genai
-from typing import List
+from typing import AsyncIterator, List, Optional, Union
+from pydantic import ValidationError
 from models import Question
 from config import settings
-from db import agents_collection
-from bson import ObjectId
-import json
+from agent_cache import agent_cache
+import asyncio
+import math
+from llm_client import generate_text, forget_text, stream_text
+from llm_scheduler import Priority, LLMOverloadedError
+from json_stream import JSONArrayStreamParser, parse_json_array
+from prompt_builder import build_prompt, QUESTION_TEMPLATE
+from question_pool import (
+    QuestionPoolRefiller, take_pooled_questions, add_pooled_questions, served_question_keys, question_key, pool_question_id
+)
 import random
+from model_router import Task, route_models
+from metrics import stage, questions_served, questions_invalid
+from logging_config import get_logger, log_payload, truncate_payload
 
-# Configure the Gemini client
-genai.configure(api_key=settings.GOOGLE_API_KEY)
-model = genai.GenerativeModel('gemini-1.5-flash')
+logger = get_logger("question_service")
 
-async def generate_questions(agent_id: str, num_questions: int = 5, difficulty: str = None) -> List[Question]:
+# JSON mode constrained to the Question schema
+QUESTION_GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": list[Question],
+}
+
+async def generate_questions(agent_id: str, num_questions: int = 5, difficulty: str = None,
+                             use_cache: bool = True, user_id: str = None) -> List[Question]:
     """
-    Generate questions based on an agent's knowledge and topic using Gemini AI
+    Generate questions based on an agent's knowledge and topic using Gemini AI.
+    Questions are served from the pre-generated pool when possible; the pool is
+    refilled in the background.
     """
     
     # Get the agent's configuration to determine the topic and knowledge
-    agent_config = await agents_collection.find_one({"_id": ObjectId(agent_id)})
+    with stage("generate_questions", "agent_lookup"):
+        agent_config = await agent_cache.get_agent(agent_id)
     if not agent_config:
         raise ValueError("Agent not found")
     
@@ -26,110 +44,301 @@ async def generate_questions(agent_id: str, num_questions: int = 5, difficulty:
     
     # Check if knowledge_summary is empty or too short
     if not knowledge_summary or len(knowledge_summary.strip()) < 10:
-        print(f"DEBUG - Knowledge summary is empty or too short: '{knowledge_summary}'")
-        print("DEBUG - Using fallback questions due to insufficient knowledge")
-        return _create_fallback_questions(agent_id, agent_name, num_questions, difficulty)
-    
-    print(f"DEBUG - Agent: {agent_name}, Knowledge length: {len(knowledge_summary)} chars")
-    
-    difficulty_filter = f" de nivel {difficulty}" if difficulty else ""
-    
-    prompt = f"""
-Eres un experto en educación. Genera exactamente {num_questions} preguntas de opción múltiple en español{difficulty_filter}.
-
-CONOCIMIENTO BASE:
-{knowledge_summary}
-
-INSTRUCCIONES CRÍTICAS:
-- Responde SOLO con un array JSON válido
-- NO incluyas explicaciones fuera del JSON
-- NO uses markdown o bloques de código
-- Cada pregunta debe basarse en el conocimiento proporcionado
-
-FORMATO EXACTO:
-[
-  {{
-    "id": "agent-{agent_id}-1",
-    "type": "multiple_choice", 
-    "question": "¿Pregunta específica basada en el conocimiento?",
-    "options": [
-      "Respuesta correcta basada en el conocimiento",
-      "Opción incorrecta pero plausible",
-      "Otra opción incorrecta",
-      "Cuarta opción incorrecta"
-    ],
-    "correctAnswer": 0,
-    "explanation": "Explicación detallada de por qué la respuesta es correcta según el conocimiento.",
-    "difficulty": "{difficulty or 'beginner'}",
-    "topic": "{agent_name.lower()}",
-    "xp": {_calculate_xp(difficulty or 'beginner')}
-  }}
-]
-
-REGLAS:
-1. correctAnswer = índice (0-3) de la respuesta correcta
-2. Preguntas específicas al conocimiento, no genéricas
-3. Opciones realistas y educativas
-4. XP: beginner(80-100), intermediate(100-130), advanced(130-160)
-
-Genera el JSON ahora:
+        logger.debug("Knowledge summary too short, using fallback questions",
+                     extra={"agent_id": agent_id, "summary_chars": len(knowledge_summary or "")})
+        questions_served.inc(num_questions, source="fallback")
+        return create_fallback_questions(agent_id, agent_name, num_questions, difficulty)
+    
+    logger.debug("Generating questions", extra={"agent_id": agent_id, "agent_name": agent_name,
+                                                "summary_chars": len(knowledge_summary)})
+    
+    # Serve from the pool first; only the shortfall is generated on the request path
+    questions = []
+    if settings.QUESTION_POOL_ENABLED:
+        with stage("generate_questions", "pool_lookup"):
+            questions = await take_pooled_questions(agent_id, difficulty, num_questions, user_id)
+        questions_served.inc(len(questions), source="pool")
+        if len(questions) == num_questions:
+            await pool_refiller.schedule_if_low(agent_id, difficulty)
+            return questions
+    
+    missing = num_questions - len(questions)
+    # With the pool on, a cached response would repeat questions the pool already served
+    use_cache = use_cache and not settings.QUESTION_POOL_ENABLED
+    try:
+        generated = await generate_question_batches(agent_id, agent_name, knowledge_summary, missing, difficulty, use_cache)
+    except LLMOverloadedError:
+        # Degrade gracefully: pooled questions are still worth serving while the model is unavailable
+        if not questions:
+            raise
+        logger.warning("Model unavailable, serving pooled questions plus fallback",
+                       extra={"agent_id": agent_id, "pooled": len(questions)})
+        generated = []
+    
+    if settings.QUESTION_POOL_ENABLED:
+        # Drops generated questions this user has already been served
+        generated = await add_pooled_questions(agent_id, difficulty, generated, served_to=user_id)
+        # Anonymous requests have no served history, so also drop repeats of the pooled questions taken above
+        taken = {question_key(question) for question in questions}
+        generated = [question for question in generated if question_key(question) not in taken]
+        await pool_refiller.schedule_if_low(agent_id, difficulty)
+    questions_served.inc(len(generated), source="generated")
+    
+    # Fallback: only the sub-batches that failed are replaced with sample questions
+    shortfall = missing - len(generated)
+    if shortfall > 0:
+        questions_served.inc(shortfall, source="fallback")
+        generated += create_fallback_questions(
+            agent_id, agent_name, shortfall, difficulty, start_index=len(questions) + len(generated)
+        )
+    return questions + generated
+
+
+async def generate_question_batches(agent_id: str, agent_name: str, knowledge_summary: Union[str, List[str]],
+                                    num_questions: int, difficulty: str = None, use_cache: bool = True,
+                                    priority: Priority = Priority.QUESTIONS) -> List[Question]:
     """
+    Generate questions in concurrent sub-batches of at most QUESTION_BATCH_SIZE.
+    The knowledge is the agent's summary or a list of raw document excerpts.
+    Failed sub-batches are retried on their own; results are merged and de-duplicated
+    by question text. May return fewer questions than requested; raises
+    LLMOverloadedError only if nothing was generated because the model was saturated.
+    """
+    batch_count = math.ceil(num_questions / settings.QUESTION_BATCH_SIZE)
+    base, extra = divmod(num_questions, batch_count)
+    batch_sizes = [base + (1 if i < extra else 0) for i in range(batch_count)]
+    semaphore = asyncio.Semaphore(settings.QUESTION_BATCH_CONCURRENCY)
+    overloaded = []
+    
+    async def run_batch(index: int, size: int) -> List[Question]:
+        for attempt in range(settings.QUESTION_BATCH_RETRIES + 1):
+            try:
+                async with semaphore:
+                    # Retries skip the cache so a bad cached answer isn't returned again,
+                    # and go to the model configured for retries
+                    return await _request_questions(
+                        agent_id, agent_name, knowledge_summary, size, difficulty,
+                        use_cache=use_cache and attempt == 0,
+                        batch_index=index, batch_count=batch_count, priority=priority,
+                        task=Task.QUESTIONS if attempt == 0 else Task.QUESTIONS_RETRY
+                    )
+            except LLMOverloadedError as e:
+                # Retrying immediately can't help when there is no capacity
+                overloaded.append(e)
+                break
+            except Exception as e:
+                logger.warning("Question batch failed: %s", e, extra={"batch": index + 1, "batch_count": batch_count})
+        return []
     
+    results = await asyncio.gather(*(run_batch(i, size) for i, size in enumerate(batch_sizes)))
+    
+    # Merge, drop duplicate questions and renumber ids so they stay unique
+    merged = []
+    seen = set()
+    for batch, size in zip(results, batch_sizes):
+        for question in batch[:size]:
+            key = question_key(question)
+            if key in seen:
+                continue
+            seen.add(key)
+            merged.append(question.model_copy(update={"id": f"agent-{agent_id}-{len(merged) + 1}"}))
+    
+    if not merged and overloaded:
+        raise overloaded[0]
+    return merged
+
+
+def _build_question_prompt(agent_id: str, agent_name: str, knowledge_summary: Union[str, List[str]], num_questions: int,
+                           difficulty: str = None, batch_index: int = 0, batch_count: int = 1) -> str:
+    # Sub-batches get distinct prompts so they cover different material (and cache separately)
+    batch_instruction = (
+        f"- Este es el lote {batch_index + 1} de {batch_count}: cubre aspectos del conocimiento distintos a los de los otros lotes"
+        if batch_count > 1 else ""
+    )
+    return build_prompt(
+        QUESTION_TEMPLATE,
+        settings.QUESTION_PROMPT_MAX_TOKENS,
+        knowledge_summary,
+        num_questions=num_questions,
+        difficulty_filter=f" de nivel {difficulty}" if difficulty else "",
+        difficulty=difficulty or "beginner",
+        topic=agent_name.lower(),
+        batch_instruction=batch_instruction,
+    ).text
+
+
+def _to_question(q_data: dict, agent_id: str, agent_name: str, index: int) -> Optional[Question]:
+    """Validate one generated question object; returns None if it is unusable"""
+    if not isinstance(q_data, dict):
+        return None
     try:
-        response = await model.generate_content_async(prompt)
-        
-        # Clean the response text
-        response_text = response.text.strip()
-        
-        # Remove any markdown code blocks if present
-        if response_text.startswith('```json'):
-            response_text = response_text[7:]
-        if response_text.startswith('```'):
-            response_text = response_text[3:]
-        if response_text.endswith('```'):
-            response_text = response_text[:-3]
-        
-        response_text = response_text.strip()
-        
-        print(f"DEBUG - Raw AI response: {response_text[:500]}...")  # Debug output
-        
-        # Parse the JSON response
-        questions_data = json.loads(response_text)
-        
-        # Validate that we got a list
-        if not isinstance(questions_data, list):
-            print("DEBUG - Response is not a list, falling back")
-            return _create_fallback_questions(agent_id, agent_name, num_questions, difficulty)
-        
-        # Convert to Question objects
-        questions = []
-        for i, q_data in enumerate(questions_data):
-            # Ensure the question has all required fields
-            question = Question(
-                id=q_data.get("id", f"agent-{agent_id}-{i+1}"),
-                type=q_data.get("type", "multiple_choice"),
-                question=q_data.get("question", ""),
-                options=q_data.get("options", []),
-                correctAnswer=q_data.get("correctAnswer", 0),
-                explanation=q_data.get("explanation", ""),
-                difficulty=q_data.get("difficulty", "beginner"),
-                topic=q_data.get("topic", agent_name.lower()),
-                xp=q_data.get("xp", _calculate_xp(q_data.get("difficulty", "beginner")))
-            )
-            questions.append(question)
-            
-        print(f"DEBUG - Successfully generated {len(questions)} questions")  # Debug output
-        return questions
+        # Ensure the question has all required fields
+        return Question(
+            id=q_data.get("id", f"agent-{agent_id}-{index+1}"),
+            type=q_data.get("type", "multiple_choice"),
+            question=q_data.get("question", ""),
+            options=q_data.get("options", []),
+            correctAnswer=q_data.get("correctAnswer", 0),
+            explanation=q_data.get("explanation", ""),
+            difficulty=q_data.get("difficulty", "beginner"),
+            topic=q_data.get("topic", agent_name.lower()),
+            xp=q_data.get("xp", _calculate_xp(q_data.get("difficulty", "beginner")))
+        )
+    except ValidationError as e:
+        logger.debug("Skipping invalid question: %s", e)
+        return None
+
+
+async def _request_questions(agent_id: str, agent_name: str, knowledge_summary: Union[str, List[str]],
+                             num_questions: int, difficulty: str = None, use_cache: bool = True,
+                             batch_index: int = 0, batch_count: int = 1,
+                             priority: Priority = Priority.QUESTIONS,
+                             task: Task = Task.QUESTIONS) -> List[Question]:
+    """
+    Ask the model routed for `task` for questions (JSON mode, schema from models.Question) and parse them.
+    Invalid objects are skipped individually; raises only if nothing usable came back,
+    so callers decide how to fall back.
+    """
+    with stage("generate_questions", "prompt_build"):
+        prompt = _build_question_prompt(
+            agent_id, agent_name, knowledge_summary, num_questions, difficulty, batch_index, batch_count
+        )
+    models = route_models(task)
+    with stage("generate_questions", "model_call"):
+        raw_text = await generate_text(
+            models, prompt, use_cache=use_cache, generation_config=QUESTION_GENERATION_CONFIG, priority=priority
+        )
+    
+    log_payload(logger, "Raw model response", raw_text, agent_id=agent_id)
+    
+    # Parse object by object so one malformed question doesn't discard the rest
+    with stage("generate_questions", "json_parse"):
+        objects = parse_json_array(raw_text)
+    questions = []
+    with stage("generate_questions", "validation"):
+        for i, q_data in enumerate(objects):
+            question = _to_question(q_data, agent_id, agent_name, i)
+            if question is not None:
+                questions.append(question)
+    questions_invalid.inc(len(objects) - len(questions))
+    
+    if not questions:
+        logger.warning("Model response contained no valid questions",
+                       extra={"agent_id": agent_id, "payload": truncate_payload(raw_text)})
+        # Don't keep serving a malformed response from the cache
+        await forget_text(models, prompt, generation_config=QUESTION_GENERATION_CONFIG)
+        raise ValueError("Model response contained no valid questions")
         
-    except json.JSONDecodeError as e:
-        print(f"DEBUG - JSON decode error: {e}")  # Debug output
-        print(f"DEBUG - Failed to parse: {response.text[:200]}...")  # Debug output
-        # Fallback: create sample questions if JSON parsing fails
-        return _create_fallback_questions(agent_id, agent_name, num_questions, difficulty)
+    logger.debug("Generated questions", extra={"agent_id": agent_id, "count": len(questions)})
+    return questions
+
+
+async def stream_questions(agent_id: str, num_questions: int = 5, difficulty: str = None,
+                           use_cache: bool = True, user_id: str = None) -> AsyncIterator[Question]:
+    """
+    Like generate_questions, but returns an async iterator that yields each question
+    as soon as it is available: pooled questions first, then each generated question
+    as soon as its JSON object closes in the model stream.
+    Raises ValueError before streaming if the agent does not exist; the iterator
+    raises LLMOverloadedError if the model is saturated before anything was yielded.
+    """
+    agent_config = await agent_cache.get_agent(agent_id)
+    if not agent_config:
+        raise ValueError("Agent not found")
+    
+    knowledge_summary = agent_config.get('knowledge_summary', '')
+    agent_name = agent_config.get('name', 'conocimiento general')
+    return _stream_questions(agent_id, agent_name, knowledge_summary, num_questions, difficulty, use_cache, user_id)
+
+
+async def _stream_questions(agent_id: str, agent_name: str, knowledge_summary: str, num_questions: int,
+                            difficulty: str, use_cache: bool, user_id: str) -> AsyncIterator[Question]:
+    if not knowledge_summary or len(knowledge_summary.strip()) < 10:
+        questions_served.inc(num_questions, source="fallback")
+        for question in create_fallback_questions(agent_id, agent_name, num_questions, difficulty):
+            yield question
+        return
+    
+    served = 0
+    seen = set()
+    if settings.QUESTION_POOL_ENABLED:
+        for question in await take_pooled_questions(agent_id, difficulty, num_questions, user_id):
+            seen.add(question_key(question))
+            served += 1
+            questions_served.inc(source="pool")
+            yield question
+        if served == num_questions:
+            await pool_refiller.schedule_if_low(agent_id, difficulty)
+            return
+    
+    missing = num_questions - served
+    prompt = _build_question_prompt(agent_id, agent_name, knowledge_summary, missing, difficulty)
+    parser = JSONArrayStreamParser()
+    generated = []
+    chunks = stream_text(
+        route_models(Task.QUESTIONS), prompt, use_cache=use_cache and not settings.QUESTION_POOL_ENABLED, generation_config=QUESTION_GENERATION_CONFIG,
+        priority=Priority.QUESTIONS
+    )
+    try:
+        async for chunk in chunks:
+            for q_data in parser.feed(chunk):
+                question = _to_question(q_data, agent_id, agent_name, served + len(generated))
+                if question is None:
+                    questions_invalid.inc()
+                    continue
+                if len(generated) >= missing:
+                    continue
+                key = question_key(question)
+                if key in seen:
+                    continue
+                seen.add(key)
+                if user_id and settings.QUESTION_POOL_ENABLED and \
+                        await served_question_keys(agent_id, difficulty, [key], user_id):
+                    continue
+                if settings.QUESTION_POOL_ENABLED:
+                    question_id = pool_question_id(agent_id, question)
+                else:
+                    question_id = f"agent-{agent_id}-{served + len(generated) + 1}"
+                question = question.model_copy(update={"id": question_id})
+                generated.append(question)
+                questions_served.inc(source="generated")
+                yield question
+    except LLMOverloadedError:
+        # Same as generate_questions: only degrade to fallback once something was served
+        if not served and not generated:
+            raise
+        logger.warning("Model unavailable, completing the stream with fallback questions",
+                       extra={"agent_id": agent_id, "served": served + len(generated)})
     except Exception as e:
-        print(f"DEBUG - General error: {e}")  # Debug output
-        # Fallback: create sample questions if anything goes wrong
-        return _create_fallback_questions(agent_id, agent_name, num_questions, difficulty)
+        logger.warning("Error while streaming questions: %s", e, extra={"agent_id": agent_id})
+    finally:
+        # Stops generation upstream if the client went away
+        await chunks.aclose()
+    
+    if settings.QUESTION_POOL_ENABLED and generated:
+        await add_pooled_questions(agent_id, difficulty, generated, served_to=user_id)
+        await pool_refiller.schedule_if_low(agent_id, difficulty)
+    
+    shortfall = missing - len(generated)
+    questions_served.inc(max(0, shortfall), source="fallback")
+    for question in create_fallback_questions(agent_id, agent_name, shortfall, difficulty,
+                                              start_index=served + len(generated)):
+        yield question
+
+
+async def _refill_pool(agent_id: str, difficulty: str, batch_size: int) -> List[Question]:
+    """Generate a fresh batch for the pool (never served from the LLM cache)"""
+    agent_config = await agent_cache.get_agent(agent_id)
+    if not agent_config or len((agent_config.get('knowledge_summary') or '').strip()) < 10:
+        return []
+    agent_name = agent_config.get('name', 'conocimiento general')
+    return await generate_question_batches(
+        agent_id, agent_name, agent_config['knowledge_summary'], batch_size, difficulty,
+        use_cache=False, priority=Priority.BACKGROUND
+    )
+
+
+pool_refiller = QuestionPoolRefiller(_refill_pool)
 
 def _calculate_xp(difficulty: str) -> int:
     """Calculate XP based on difficulty level"""
@@ -141,7 +350,8 @@ def _calculate_xp(difficulty: str) -> int:
     min_xp, max_xp = xp_ranges.get(difficulty, (80, 100))
     return random.randint(min_xp, max_xp)
 
-def _create_fallback_questions(agent_id: str, agent_name: str, num_questions: int, difficulty: str = None) -> List[Question]:
+def create_fallback_questions(agent_id: str, agent_name: str, num_questions: int, difficulty: str = None,
+                              start_index: int = 0) -> List[Question]:
     """Create fallback questions when AI generation fails"""
     
     fallback_questions = []
@@ -151,7 +361,7 @@ def _create_fallback_questions(agent_id: str, agent_name: str, num_questions: in
         diff = difficulty if difficulty else random.choice(difficulties)
         
         question = Question(
-            id=f"agent-{agent_id}-{i+1}",
+            id=f"agent-{agent_id}-{start_index+i+1}",
             type="multiple_choice",
             question=f"¿Cuál es un aspecto importante del conocimiento de {agent_name}?",
             options=[
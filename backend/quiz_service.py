@@ -0,0 +1,92 @@
+import asyncio
+from typing import List, Optional
+from bson import ObjectId
+from models import Question
+from config import settings
+from chunking import estimate_tokens, split_into_chunks
+from agent_service import compute_content_hash, create_agent_from_docs, find_agent_by_content
+from question_service import generate_questions, generate_question_batches, create_fallback_questions
+from question_pool import add_pooled_questions
+from prompt_builder import KNOWLEDGE_SEPARATOR, QUESTION_TEMPLATE
+from metrics import stage, questions_served
+from logging_config import get_logger
+
+logger = get_logger("quiz_service")
+
+
+def select_excerpts(documents: List[str], budget_tokens: int) -> List[str]:
+    """
+    Pick raw document chunks for the question prompt. When the documents don't
+    fit into `budget_tokens`, evenly spaced chunks are kept (in document order)
+    so the questions cover the whole upload rather than only its beginning.
+    """
+    chunk_tokens = settings.RETRIEVAL_CHUNK_TOKENS
+    chunks = split_into_chunks(documents, chunk_tokens)
+    fits = max(1, budget_tokens // (chunk_tokens + estimate_tokens(KNOWLEDGE_SEPARATOR)))
+    if len(chunks) <= fits:
+        return chunks
+    step = len(chunks) / fits
+    return [chunks[int(i * step)] for i in range(fits)]
+
+
+async def create_quiz(name: str, system_prompt: str, documents: List[str], num_questions: int = 5,
+                      difficulty: str = None, use_cache: bool = True, user_id: str = None) -> dict:
+    """
+    Create (or reuse) the agent for `documents` and generate its first quiz in one pipeline.
+
+    For new content the summary and the questions are generated concurrently:
+    the questions are asked from the raw document chunks instead of waiting for
+    the summary. Content that already has an agent goes through the regular
+    question path (pool first). Returns {"agent": AgentConfig, "questions": [...]}.
+    """
+    # 1. Identical content already has an agent; no summarization needed
+    with stage("quiz", "dedup_lookup"):
+        existing_agent = await find_agent_by_content(compute_content_hash(name, system_prompt, documents))
+    if existing_agent:
+        questions = await generate_questions(existing_agent.id, num_questions, difficulty,
+                                             use_cache=use_cache, user_id=user_id)
+        return {"agent": existing_agent, "questions": questions}
+
+    # 2. Select the excerpts the questions are generated from
+    with stage("quiz", "excerpt_selection"):
+        budget = settings.QUESTION_PROMPT_MAX_TOKENS - QUESTION_TEMPLATE.static_tokens
+        excerpts = select_excerpts(documents, budget)
+
+    # 3. Summarize and generate questions concurrently. Question ids are assigned
+    # once the agent exists, so a provisional id is used meanwhile.
+    agent_task = asyncio.create_task(create_agent_from_docs(name, system_prompt, documents, use_cache=use_cache))
+    questions_task = asyncio.create_task(
+        _generate_quiz_questions(str(ObjectId()), name, excerpts, num_questions, difficulty, use_cache)
+    )
+    try:
+        with stage("quiz", "pipeline"):
+            agent, generated = await asyncio.gather(agent_task, questions_task)
+    except BaseException:
+        # Don't leave the other half running (or its error unretrieved)
+        for task in (agent_task, questions_task):
+            task.cancel()
+        await asyncio.gather(agent_task, questions_task, return_exceptions=True)
+        raise
+    questions_served.inc(len(generated), source="generated")
+
+    # 4. Give the questions their final ids (and pool them for later quizzes)
+    if settings.QUESTION_POOL_ENABLED:
+        generated = await add_pooled_questions(agent.id, difficulty, generated, served_to=user_id)
+    else:
+        generated = [q.model_copy(update={"id": f"agent-{agent.id}-{i + 1}"}) for i, q in enumerate(generated)]
+
+    # 5. Only the questions that couldn't be generated are replaced with sample questions
+    shortfall = num_questions - len(generated)
+    if shortfall > 0:
+        questions_served.inc(shortfall, source="fallback")
+        generated += create_fallback_questions(agent.id, agent.name, shortfall, difficulty, start_index=len(generated))
+    logger.debug("Quiz created", extra={"agent_id": agent.id, "questions": len(generated), "excerpts": len(excerpts)})
+    return {"agent": agent, "questions": generated}
+
+
+async def _generate_quiz_questions(provisional_id: str, name: str, excerpts: List[str], num_questions: int,
+                                   difficulty: Optional[str], use_cache: bool) -> List[Question]:
+    if not excerpts or len("".join(excerpts).strip()) < 10:
+        return []
+    with stage("quiz", "question_generation"):
+        return await generate_question_batches(provisional_id, name, excerpts, num_questions, difficulty, use_cache)
@@ -0,0 +1,131 @@
+import asyncio
+import random
+import time
+from typing import Awaitable, Callable, Optional, TypeVar
+from google.api_core import exceptions as google_exceptions
+from config import settings
+from llm_scheduler import LLMOverloadedError
+from logging_config import get_logger
+
+logger = get_logger("resilience")
+
+T = TypeVar("T")
+
+# Transient provider errors worth retrying (429, 500, 503, 504)
+_RETRYABLE_ERRORS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.InternalServerError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    asyncio.TimeoutError,
+)
+
+
+class CircuitOpenError(LLMOverloadedError):
+    """Raised without calling the model while the provider is considered degraded"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    return isinstance(error, _RETRYABLE_ERRORS)
+
+
+class CircuitBreaker:
+    """
+    Classic closed / open / half-open breaker.
+
+    After `failure_threshold` consecutive transient failures the circuit opens and
+    calls fail fast for `reset_seconds`. Then a single trial call is let through:
+    success closes the circuit, failure opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_progress = False
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def before_call(self) -> None:
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self._trial_in_progress:
+            self._trial_in_progress = True
+            return
+        self.rejected += 1
+        remaining = max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+        raise CircuitOpenError("Model provider is degraded; failing fast", retry_after=remaining or 1.0)
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        if self._trial_in_progress or self.consecutive_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial_in_progress = False
+
+    def release_trial(self) -> None:
+        """The trial call ended without telling us anything about the provider"""
+        self._trial_in_progress = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "rejected": self.rejected,
+        }
+
+
+def backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff"""
+    ceiling = min(settings.LLM_RETRY_MAX_DELAY_SECONDS, settings.LLM_RETRY_BASE_DELAY_SECONDS * (2 ** attempt))
+    return random.uniform(0, ceiling)
+
+
+async def call_with_retries(fn: Callable[[], Awaitable[T]], breaker: CircuitBreaker,
+                            max_retries: int = None) -> T:
+    """
+    Run `fn` under the circuit breaker, retrying transient failures with jittered backoff.
+    Non-transient errors (bad request, overload rejection) are raised immediately.
+    """
+    max_retries = settings.LLM_MAX_RETRIES if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            result = await fn()
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.release_trial()
+                raise
+            breaker.record_failure()
+            if attempt >= max_retries:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning("Model call failed, retrying", extra={
+                "error": type(e).__name__, "retry": attempt + 1, "max_retries": max_retries, "delay_seconds": round(delay, 2),
+            })
+            await asyncio.sleep(delay)
+            attempt += 1
+            continue
+        except BaseException:
+            # Cancelled: no verdict on the provider
+            breaker.release_trial()
+            raise
+        breaker.record_success()
+        return result
+
@@ -0,0 +1,132 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import List, Optional
+from bson import ObjectId
+from chunking import split_into_chunks
+from config import settings
+from db import agent_chunks_collection
+
+# BM25 parameters (standard Okapi defaults)
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+# Very common Spanish/English words that carry no retrieval signal
+_STOPWORDS = {
+    "a", "al", "algo", "como", "con", "de", "del", "el", "ella", "en", "es", "esta", "este",
+    "la", "las", "le", "lo", "los", "mas", "me", "mi", "no", "o", "para", "pero", "por",
+    "que", "se", "si", "sin", "su", "sus", "te", "tu", "un", "una", "uno", "y", "ya",
+    "an", "and", "are", "as", "at", "be", "by", "for", "from", "how", "in", "is", "it",
+    "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "which", "with",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, strip accents and split into word tokens, dropping stopwords"""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return [
+        token for token in _TOKEN_PATTERN.findall(text)
+        if len(token) > 1 and token not in _STOPWORDS
+    ]
+
+
+def build_chunk_records(agent_id: ObjectId, documents: List[str]) -> List[dict]:
+    """Chunk documents and precompute the term statistics BM25 needs"""
+    records = []
+    for position, text in enumerate(split_into_chunks(documents, settings.RETRIEVAL_CHUNK_TOKENS)):
+        term_freqs = Counter(tokenize(text))
+        records.append({
+            "agent_id": agent_id,
+            "position": position,
+            "text": text,
+            "terms": list(term_freqs),
+            "term_freqs": dict(term_freqs),
+            "length": sum(term_freqs.values()),
+        })
+    return records
+
+
+def rank_chunks(query_terms: List[str], candidates: List[dict], total_chunks: int,
+                avg_length: float, top_k: int) -> List[dict]:
+    """
+    Score candidate chunks with BM25 and return the top_k best.
+    Candidates should be the chunks containing at least one query term; the
+    document frequencies computed here are exact unless the candidates were capped.
+    """
+    unique_terms = set(query_terms)
+    doc_freqs = Counter(term for chunk in candidates for term in unique_terms if term in chunk["term_freqs"])
+    avg_length = avg_length or 1.0
+
+    scored = []
+    for chunk in candidates:
+        score = 0.0
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk["length"] / avg_length)
+        for term in unique_terms:
+            freq = chunk["term_freqs"].get(term, 0)
+            if not freq:
+                continue
+            df = doc_freqs[term]
+            idf = math.log(1 + (total_chunks - df + 0.5) / (df + 0.5))
+            score += idf * freq * (BM25_K1 + 1) / (freq + length_norm)
+        scored.append((score, chunk["position"], chunk))
+
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [chunk for score, _, chunk in scored[:top_k] if score > 0]
+
+
+def retrieval_stats(records: List[dict]) -> Optional[dict]:
+    """Corpus-level statistics stored on the agent document"""
+    if not records:
+        return None
+    return {
+        "chunk_count": len(records),
+        "avg_chunk_length": sum(r["length"] for r in records) / len(records),
+    }
+
+
+async def save_chunk_records(records: List[dict]) -> None:
+    """Persist an agent's chunk index"""
+    if records:
+        await agent_chunks_collection.insert_many(records, ordered=False)
+
+
+async def retrieve_relevant_chunks(agent_config: dict, query: str, top_k: int = None) -> Optional[List[str]]:
+    """
+    Return the texts of the top_k chunks most relevant to the query, in document order.
+    Returns None when the agent has no index or nothing matches, so callers can fall back
+    to the knowledge summary.
+    """
+    stats = agent_config.get("retrieval")
+    if not settings.RETRIEVAL_ENABLED or not stats:
+        return None
+
+    query_terms = tokenize(query)
+    if not query_terms:
+        return None
+
+    # Rank on term statistics only, over a bounded set of candidates
+    limit = settings.RETRIEVAL_MAX_CANDIDATES
+    candidates = await agent_chunks_collection.find(
+        {"agent_id": agent_config["_id"], "terms": {"$in": list(set(query_terms))}},
+        {"term_freqs": 1, "length": 1, "position": 1},
+    ).limit(limit).to_list(length=limit)
+
+    best = rank_chunks(
+        query_terms,
+        candidates,
+        stats["chunk_count"],
+        stats["avg_chunk_length"],
+        top_k or settings.RETRIEVAL_TOP_K,
+    )
+    if not best:
+        return None
+
+    # Only the winners' texts are read
+    chunks = await agent_chunks_collection.find(
+        {"_id": {"$in": [chunk["_id"] for chunk in best]}}, {"text": 1, "position": 1}
+    ).to_list(length=len(best))
+    return [chunk["text"] for chunk in sorted(chunks, key=lambda c: c["position"])]
@@ -1,16 +1,41 @@
-from fastapi import APIRouter, Body, HTTPException
-from typing import List
-from models import AgentConfig, Question, QuestionRequest
-from agent_service import create_agent_from_docs, get_agent_response
-from question_service import generate_questions
+import asyncio
+from fastapi import APIRouter, Body, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from typing import AsyncIterator, List
+from bson import ObjectId
+import json
+from models import AgentConfig, Answer, GradingResult, PublicQuestion, QuestionRequest, Quiz
+from agent_service import create_agent_from_docs, get_agent_response, stream_agent_response
+from question_service import generate_questions, stream_questions
+from quiz_service import create_quiz
+from grading_service import create_quiz_session, grade_answers
+from conversation_service import create_conversation, get_conversation, send_message
+from agent_repository import set_agent_pinned
+from llm_cache import response_cache
+from agent_cache import agent_cache
+from llm_client import inflight_calls
+from llm_scheduler import llm_scheduler, LLMOverloadedError
+from model_router import model_router
+from setup_jobs import setup_job_runner, get_setup_job, FINISHED_STATUSES
+from config import settings
+from document_extraction import check_request_size, extract_uploaded_documents, DocumentUploadError
 
 router = APIRouter()
 
+
+def _overloaded(e: LLMOverloadedError) -> HTTPException:
+    """503 telling the client when model capacity is expected to free up"""
+    headers = {"Retry-After": str(max(1, round(e.retry_after)))} if e.retry_after else None
+    return HTTPException(status_code=503, detail=str(e), headers=headers)
+
+
 @router.post("/setup-agent/", response_model=AgentConfig)
 async def setup_agent_endpoint(
     name: str = Body(...),
     system_prompt: str = Body(...),
-    documents: List[str] = Body(...)
+    documents: List[str] = Body(...),
+    use_cache: bool = True
 ):
     """
     Creates and configures an agent based on a set of documents.
@@ -18,26 +43,240 @@ async def setup_agent_endpoint(
     if not documents:
         raise HTTPException(status_code=400, detail="No documents provided.")
         
-    new_agent = await create_agent_from_docs(name, system_prompt, documents)
+    try:
+        new_agent = await create_agent_from_docs(name, system_prompt, documents, use_cache=use_cache)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
     return new_agent
 
+@router.post("/setup-agent/upload/", response_model=AgentConfig)
+async def setup_agent_upload_endpoint(
+    request: Request,
+    use_cache: bool = True,
+    background: bool = False
+):
+    """
+    Creates an agent from uploaded files (multipart/form-data with `name`,
+    `system_prompt` and one or more `files`; .txt, .md or .pdf).
+    Uploads are rejected from their Content-Length before the body is parsed, and
+    text is extracted server-side. With `background=true` the agent is created as
+    a setup job and the job is returned with status 202.
+    """
+    try:
+        check_request_size(request.headers.get("content-length"))
+        async with request.form(max_files=settings.UPLOAD_MAX_FILES) as form:
+            name, system_prompt = form.get("name"), form.get("system_prompt")
+            if not isinstance(name, str) or not isinstance(system_prompt, str):
+                raise HTTPException(status_code=422, detail="The name and system_prompt fields are required.")
+            files = [upload for upload in form.getlist("files") if not isinstance(upload, str)]
+            documents = await extract_uploaded_documents(files)
+    except DocumentUploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    
+    if background:
+        job = await setup_job_runner.submit(name, system_prompt, documents, use_cache=use_cache)
+        return JSONResponse(
+            status_code=202,
+            content=jsonable_encoder(job),
+            headers={"Location": f"/api/setup-agent/jobs/{job['job_id']}"},
+        )
+    try:
+        return await create_agent_from_docs(name, system_prompt, documents, use_cache=use_cache)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
+
+@router.post("/setup-agent/jobs/", status_code=202)
+async def submit_setup_agent_job(
+    name: str = Body(...),
+    system_prompt: str = Body(...),
+    documents: List[str] = Body(...),
+    use_cache: bool = True
+):
+    """
+    Queues agent creation and returns a job id immediately.
+    Poll `GET /setup-agent/jobs/{job_id}` (or subscribe to `/events`) for the result.
+    """
+    if not documents:
+        raise HTTPException(status_code=400, detail="No documents provided.")
+    
+    job = await setup_job_runner.submit(name, system_prompt, documents, use_cache=use_cache)
+    return JSONResponse(
+        status_code=202,
+        content=jsonable_encoder(job),
+        headers={"Location": f"/api/setup-agent/jobs/{job['job_id']}"},
+    )
+
+@router.get("/setup-agent/jobs/{job_id}")
+async def get_setup_agent_job(job_id: str):
+    """
+    Returns the job status; completed jobs include the created agent, failed jobs the error.
+    """
+    job = await get_setup_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return job
+
+@router.get("/setup-agent/jobs/{job_id}/events")
+async def stream_setup_agent_job(request: Request, job_id: str):
+    """
+    Streams `event: status` messages as server-sent events whenever the job changes,
+    ending after the completed/failed status.
+    """
+    job = await get_setup_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+
+    async def event_stream() -> AsyncIterator[str]:
+        current = job
+        last_sent = None
+        while True:
+            snapshot = (current["status"], current["attempts"])
+            if snapshot != last_sent:
+                yield _sse_event(jsonable_encoder(current), event="status")
+                last_sent = snapshot
+            if current["status"] in FINISHED_STATUSES or await request.is_disconnected():
+                return
+            await asyncio.sleep(settings.SETUP_JOB_POLL_SECONDS)
+            current = await get_setup_job(job_id)
+            if current is None:
+                return
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.put("/agent/{agent_id}/pin/")
+async def pin_agent_endpoint(agent_id: str, pinned: bool = Body(embed=True)):
+    """
+    Pins (or unpins) an agent. Unpinned agents are deleted after going unused
+    for AGENT_TTL_SECONDS; pinned agents are kept indefinitely.
+    """
+    if not ObjectId.is_valid(agent_id) or not await set_agent_pinned(agent_id, pinned):
+        raise HTTPException(status_code=404, detail="Agent not found.")
+    return {"agent_id": agent_id, "pinned": pinned}
+
 @router.post("/agent/{agent_id}/chat/")
-async def chat_with_agent(agent_id: str, user_prompt: str = Body(embed=True)):
+async def chat_with_agent(agent_id: str, user_prompt: str = Body(embed=True), use_cache: bool = True):
     """
     Interacts with a specific, configured agent.
     """
-    response = await get_agent_response(agent_id, user_prompt)
+    try:
+        response = await get_agent_response(agent_id, user_prompt, use_cache=use_cache)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
     if response is None:
         raise HTTPException(status_code=404, detail="Agent not found.")
     
     return {"response": response}
 
 
-@router.post("/agent/{agent_id}/generate-questions/", response_model=List[Question])
+@router.post("/agent/{agent_id}/conversations/", status_code=201)
+async def create_conversation_endpoint(agent_id: str):
+    """
+    Starts a server-side conversation with an agent.
+    Send messages to `/conversations/{conversation_id}/messages/`; the history is kept by the server.
+    """
+    conversation = await create_conversation(agent_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Agent not found.")
+    return conversation
+
+@router.get("/conversations/{conversation_id}")
+async def get_conversation_endpoint(conversation_id: str):
+    """
+    Returns the rolling summary of older messages and the recent turns.
+    """
+    conversation = await get_conversation(conversation_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found.")
+    return conversation
+
+@router.post("/conversations/{conversation_id}/messages/")
+async def send_message_endpoint(conversation_id: str, user_prompt: str = Body(embed=True), use_cache: bool = True):
+    """
+    Sends a message in a conversation and returns the agent's answer.
+    Only the recent turns and a summary of older ones go into the prompt,
+    so its size stays bounded however long the conversation runs.
+    """
+    try:
+        response = await send_message(conversation_id, user_prompt, use_cache=use_cache)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+    if response is None:
+        raise HTTPException(status_code=404, detail="Conversation not found.")
+    
+    return {"response": response}
+
+
+def _sse_event(data: dict, event: str = None) -> str:
+    """Format a server-sent event"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post("/agent/{agent_id}/chat/stream/")
+async def stream_chat_with_agent(
+    request: Request,
+    agent_id: str,
+    user_prompt: str = Body(embed=True),
+    use_cache: bool = True
+):
+    """
+    Streams the agent's answer as server-sent events.
+    
+    Each chunk is sent as `data: {"delta": "..."}`, followed by an `event: done` message.
+    Generation stops as soon as the client disconnects.
+    Returns 503 with Retry-After if the model is saturated before the first chunk.
+    """
+    chunks = await stream_agent_response(agent_id, user_prompt, use_cache=use_cache)
+    if chunks is None:
+        raise HTTPException(status_code=404, detail="Agent not found.")
+    try:
+        # Wait for the first chunk before responding, so a saturated model is still a 503
+        first = await anext(chunks, None)
+    except LLMOverloadedError as e:
+        await chunks.aclose()
+        raise _overloaded(e)
+
+    async def event_stream() -> AsyncIterator[str]:
+        try:
+            if first is not None:
+                yield _sse_event({"delta": first})
+            async for chunk in chunks:
+                if await request.is_disconnected():
+                    break
+                yield _sse_event({"delta": chunk})
+            else:
+                yield _sse_event({}, event="done")
+        except LLMOverloadedError as e:
+            yield _sse_event({"detail": str(e), "retry_after": e.retry_after}, event="error")
+        except Exception as e:
+            yield _sse_event({"detail": str(e)}, event="error")
+        finally:
+            # Closes the upstream model stream if we stopped early
+            await chunks.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/agent/{agent_id}/generate-questions/", response_model=List[PublicQuestion])
 async def generate_questions_endpoint(
+    response: Response,
     agent_id: str,
     num_questions: int = Body(default=5),
-    difficulty: str = Body(default=None)
+    difficulty: str = Body(default=None),
+    user_id: str = Body(default=None),
+    use_cache: bool = True
 ):
     """
     Generates educational questions based on an agent's knowledge and topic.
@@ -46,9 +285,13 @@ async def generate_questions_endpoint(
         agent_id: The ID of the agent to generate questions for
         num_questions: Number of questions to generate (1-20, default: 5)
         difficulty: Optional difficulty level ('beginner', 'intermediate', 'advanced')
+        user_id: Optional user id; pooled questions already served to this user are skipped
+        use_cache: Set to false to bypass the LLM response cache
     
     Returns:
-        List of questions with multiple choice options, correct answers, and explanations
+        List of questions with multiple choice options. Correct answers and explanations
+        are only returned by grading.
+        The `X-Quiz-Session-ID` header identifies the quiz for `/quiz/{session_id}/grade/`.
     """
     if num_questions < 1 or num_questions > 20:
         raise HTTPException(status_code=400, detail="Number of questions must be between 1 and 20.")
@@ -57,9 +300,160 @@ async def generate_questions_endpoint(
         raise HTTPException(status_code=400, detail="Difficulty must be 'beginner', 'intermediate', or 'advanced'.")
     
     try:
-        questions = await generate_questions(agent_id, num_questions, difficulty)
+        questions = await generate_questions(agent_id, num_questions, difficulty, use_cache=use_cache, user_id=user_id)
+        response.headers["X-Quiz-Session-ID"] = await create_quiz_session(agent_id, questions, user_id)
         return questions
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error generating questions: {str(e)}")
+
+
+@router.post("/agent/{agent_id}/generate-questions/stream/")
+async def stream_questions_endpoint(
+    request: Request,
+    agent_id: str,
+    num_questions: int = Body(default=5),
+    difficulty: str = Body(default=None),
+    user_id: str = Body(default=None),
+    use_cache: bool = True
+):
+    """
+    Streams generated questions as server-sent events.
+    
+    Each question is sent as an `event: question` message as soon as the model
+    finishes it, followed by an `event: done` message carrying the quiz `session_id`.
+    Returns 503 with Retry-After if the model is saturated before the first question.
+    """
+    if num_questions < 1 or num_questions > 20:
+        raise HTTPException(status_code=400, detail="Number of questions must be between 1 and 20.")
+    
+    if difficulty and difficulty not in ['beginner', 'intermediate', 'advanced']:
+        raise HTTPException(status_code=400, detail="Difficulty must be 'beginner', 'intermediate', or 'advanced'.")
+    
+    try:
+        questions = await stream_questions(agent_id, num_questions, difficulty, use_cache=use_cache, user_id=user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    try:
+        # Wait for the first question before responding, so a saturated model is still a 503
+        first = await anext(questions, None)
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
+
+    async def event_stream() -> AsyncIterator[str]:
+        served = []
+        try:
+            if first is not None:
+                served.append(first)
+                yield _sse_event(first.public(), event="question")
+            async for question in questions:
+                if await request.is_disconnected():
+                    break
+                served.append(question)
+                yield _sse_event(question.public(), event="question")
+            else:
+                session_id = await create_quiz_session(agent_id, served, user_id)
+                yield _sse_event({"session_id": session_id}, event="done")
+        except LLMOverloadedError as e:
+            yield _sse_event({"detail": str(e), "retry_after": e.retry_after}, event="error")
+        except Exception as e:
+            yield _sse_event({"detail": str(e)}, event="error")
+        finally:
+            await questions.aclose()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/quiz/", response_model=Quiz)
+async def create_quiz_endpoint(
+    name: str = Body(...),
+    system_prompt: str = Body(...),
+    documents: List[str] = Body(...),
+    num_questions: int = Body(default=5),
+    difficulty: str = Body(default=None),
+    user_id: str = Body(default=None),
+    use_cache: bool = True
+):
+    """
+    Creates an agent from documents and generates its questions in a single call.
+    
+    Summarization and question generation run concurrently (questions are asked
+    from the raw documents), so this takes about as long as the slower of the two
+    instead of `/setup-agent/` followed by `/agent/{agent_id}/generate-questions/`.
+    Returns the agent, the questions and the quiz session id used for grading.
+    """
+    if not documents:
+        raise HTTPException(status_code=400, detail="No documents provided.")
+    
+    if num_questions < 1 or num_questions > 20:
+        raise HTTPException(status_code=400, detail="Number of questions must be between 1 and 20.")
+    
+    if difficulty and difficulty not in ['beginner', 'intermediate', 'advanced']:
+        raise HTTPException(status_code=400, detail="Difficulty must be 'beginner', 'intermediate', or 'advanced'.")
+    
+    try:
+        quiz = await create_quiz(name, system_prompt, documents, num_questions, difficulty,
+                                 use_cache=use_cache, user_id=user_id)
+        quiz["session_id"] = await create_quiz_session(quiz["agent"].id, quiz["questions"], user_id)
+        return quiz
+    except LLMOverloadedError as e:
+        raise _overloaded(e)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error generating questions: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error creating quiz: {str(e)}")
+
+
+@router.post("/quiz/{session_id}/grade/", response_model=GradingResult)
+async def grade_quiz_endpoint(
+    session_id: str,
+    answers: List[Answer] = Body(...),
+    user_id: str = Body(default=None)
+):
+    """
+    Grades a batch of answers (usually the whole quiz) in one request.
+    
+    Answers are checked against the answer key stored when the quiz was served,
+    XP is computed from each question's `xp`, and the results are saved with a
+    single bulk write. Questions that were already graded earn no XP again.
+    """
+    if not answers:
+        raise HTTPException(status_code=400, detail="No answers provided.")
+    
+    if len(answers) > settings.QUIZ_MAX_ANSWERS:
+        raise HTTPException(status_code=400, detail=f"At most {settings.QUIZ_MAX_ANSWERS} answers per request.")
+    
+    try:
+        result = await grade_answers(session_id, answers, user_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Quiz session not found.")
+    return result
+
+
+@router.get("/cache/stats")
+async def cache_stats_endpoint():
+    """
+    Returns counters for the LLM response cache, in-flight call coalescing
+    and the agent config cache.
+    """
+    return {
+        "llm": response_cache.stats(),
+        "inflight": inflight_calls.stats(),
+        "agents": agent_cache.stats(),
+    }
+
+
+@router.get("/scheduler/stats")
+async def scheduler_stats_endpoint():
+    """
+    Returns queue depth, in-flight calls and wait times of the model call scheduler,
+    plus per-model call counts, latency and circuit breaker state.
+    """
+    return {**llm_scheduler.stats(), "models": model_router.stats()}
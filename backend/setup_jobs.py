@@ -0,0 +1,244 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import ReturnDocument
+from config import settings
+from db import setup_jobs_collection, setup_job_documents_collection
+from agent_service import create_agent_from_docs
+from llm_scheduler import LLMOverloadedError
+from logging_config import get_logger
+
+logger = get_logger("setup_jobs")
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+FINISHED_STATUSES = (COMPLETED, FAILED)
+
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _document_parts(job_id: ObjectId, documents: List[str]) -> List[dict]:
+    """Split the uploaded documents into parts stored apart from the job document"""
+    size = settings.SETUP_JOB_DOCUMENT_PART_CHARS
+    return [
+        {"job_id": job_id, "document": index, "part": part, "text": text[start:start + size]}
+        for index, text in enumerate(documents)
+        for part, start in enumerate(range(0, max(len(text), 1), size))
+    ]
+
+
+async def _load_documents(job_id: ObjectId) -> List[str]:
+    """Reassemble a job's uploaded documents from their parts"""
+    documents = {}
+    cursor = setup_job_documents_collection.find(
+        {"job_id": job_id}, {"_id": 0, "document": 1, "text": 1}
+    ).sort([("document", 1), ("part", 1)])
+    async for part in cursor:
+        documents.setdefault(part["document"], []).append(part["text"])
+    return ["".join(parts) for parts in documents.values()]
+
+
+def _job_view(job: dict) -> dict:
+    """Public representation of a job document"""
+    view = {
+        "job_id": str(job["_id"]),
+        "status": job["status"],
+        "attempts": job.get("attempts", 0),
+        "created_at": job.get("created_at"),
+        "updated_at": job.get("updated_at"),
+    }
+    if job["status"] == COMPLETED:
+        view["agent"] = job.get("result")
+    if job["status"] == FAILED:
+        view["error"] = job.get("error")
+    return view
+
+
+async def get_setup_job(job_id: str) -> Optional[dict]:
+    """Return the job's status (and the agent once completed), or None if it doesn't exist"""
+    try:
+        object_id = ObjectId(job_id)
+    except InvalidId:
+        return None
+    job = await setup_jobs_collection.find_one({"_id": object_id})
+    return _job_view(job) if job else None
+
+
+class SetupJobRunner:
+    """
+    Bounded pool of workers that create agents in the background.
+
+    Jobs live in Mongo: submitting inserts a pending job and wakes a local worker.
+    A worker claims a job atomically and holds a lease on it, renewed while the
+    job runs. Pending jobs and running jobs whose lease expired (their worker
+    died or the process restarted) are picked up again by the periodic sweep,
+    so work survives restarts and is shared across instances.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, workers: int = None) -> None:
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        for _ in range(workers or settings.SETUP_JOB_WORKERS):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        self._tasks.append(asyncio.create_task(self._sweep()))
+
+    async def stop(self) -> None:
+        # Interrupted jobs keep their lease and are resumed once it expires
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, name: str, system_prompt: str, documents: List[str], use_cache: bool = True) -> dict:
+        now = _now()
+        job = {
+            "_id": ObjectId(),
+            "status": PENDING,
+            "request": {
+                "name": name,
+                "system_prompt": system_prompt,
+                "use_cache": use_cache,
+            },
+            "attempts": 0,
+            "available_at": now,
+            "created_at": now,
+            "updated_at": now,
+        }
+        # The documents go in first so a worker never claims a job without them
+        parts = _document_parts(job["_id"], documents)
+        if parts:
+            await setup_job_documents_collection.insert_many(parts)
+        try:
+            await setup_jobs_collection.insert_one(job)
+        except Exception:
+            await setup_job_documents_collection.delete_many({"job_id": job["_id"]})
+            raise
+        if self._tasks:
+            self._queue.put_nowait(job["_id"])
+        return _job_view(job)
+
+    async def _sweep(self) -> None:
+        """Queue jobs that are runnable but not owned by a live worker (e.g. after a restart)"""
+        while True:
+            try:
+                now = _now()
+                cursor = setup_jobs_collection.find(
+                    {"$or": [
+                        {"status": PENDING, "available_at": {"$lte": now}},
+                        {"status": RUNNING, "lease_expires_at": {"$lt": now}},
+                    ]},
+                    {"_id": 1},
+                ).sort("created_at", 1).limit(settings.SETUP_JOB_WORKERS * 4)
+                async for job in cursor:
+                    self._queue.put_nowait(job["_id"])
+            except Exception as e:
+                logger.warning("Setup job sweep failed: %s", e)
+            await asyncio.sleep(settings.SETUP_JOB_SWEEP_SECONDS)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                job = await self._claim(job_id)
+                if job is not None:
+                    await self._run(job)
+            except Exception as e:
+                logger.warning("Setup job worker error: %s", e, extra={"job_id": str(job_id)})
+            finally:
+                self._queue.task_done()
+
+    async def _claim(self, job_id: ObjectId) -> Optional[dict]:
+        """Take ownership of a job unless another worker already holds a live lease on it"""
+        now = _now()
+        return await setup_jobs_collection.find_one_and_update(
+            {"_id": job_id, "$or": [
+                {"status": PENDING, "available_at": {"$lte": now}},
+                {"status": RUNNING, "lease_expires_at": {"$lt": now}},
+            ]},
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "lease_expires_at": now + timedelta(seconds=settings.SETUP_JOB_LEASE_SECONDS),
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def _run(self, job: dict) -> None:
+        request = job["request"]
+        heartbeat = asyncio.create_task(self._renew_lease(job["_id"]))
+        try:
+            documents = await _load_documents(job["_id"])
+            agent = await create_agent_from_docs(
+                request["name"], request["system_prompt"], documents, use_cache=request["use_cache"]
+            )
+        except LLMOverloadedError as e:
+            await self._retry_or_fail(job, e, delay=e.retry_after)
+            return
+        except Exception as e:
+            await self._retry_or_fail(job, e)
+            return
+        finally:
+            heartbeat.cancel()
+
+        await self._finish(job["_id"], {"status": COMPLETED, "agent_id": agent.id,
+                                        "result": agent.model_dump(by_alias=True)})
+        logger.info("Setup job completed", extra={"job_id": str(job["_id"]), "agent_id": agent.id})
+
+    async def _renew_lease(self, job_id: ObjectId) -> None:
+        interval = max(1.0, settings.SETUP_JOB_LEASE_SECONDS / 3)
+        while True:
+            await asyncio.sleep(interval)
+            now = _now()
+            await setup_jobs_collection.update_one(
+                {"_id": job_id, "status": RUNNING},
+                {"$set": {"lease_expires_at": now + timedelta(seconds=settings.SETUP_JOB_LEASE_SECONDS)}},
+            )
+
+    async def _retry_or_fail(self, job: dict, error: Exception, delay: float = None) -> None:
+        if job["attempts"] >= settings.SETUP_JOB_MAX_ATTEMPTS:
+            logger.warning("Setup job failed: %s", error, extra={"job_id": str(job["_id"]), "attempts": job["attempts"]})
+            await self._finish(job["_id"], {"status": FAILED, "error": str(error)})
+            return
+
+        delay = delay or settings.SETUP_JOB_RETRY_DELAY_SECONDS * job["attempts"]
+        logger.warning("Setup job attempt failed, retrying: %s", error,
+                       extra={"job_id": str(job["_id"]), "attempts": job["attempts"], "delay_seconds": delay})
+        now = _now()
+        await setup_jobs_collection.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": PENDING, "available_at": now + timedelta(seconds=delay),
+                      "last_error": str(error), "updated_at": now},
+             "$unset": {"lease_expires_at": ""}},
+        )
+        # Picked up by the sweep once available_at has passed
+
+    async def _finish(self, job_id: ObjectId, fields: dict) -> None:
+        now = _now()
+        await setup_jobs_collection.update_one(
+            {"_id": job_id},
+            {
+                "$set": {**fields, "updated_at": now,
+                         "expires_at": now + timedelta(seconds=settings.SETUP_JOB_RETENTION_SECONDS)},
+                "$unset": {"lease_expires_at": ""},
+            },
+        )
+        # The uploaded documents are no longer needed once the job is done
+        await setup_job_documents_collection.delete_many({"job_id": job_id})
+
+
+setup_job_runner = SetupJobRunner()
@@ -0,0 +1,57 @@
+import asyncio
+from typing import List
+from chunking import split_into_chunks
+from config import settings
+from llm_client import generate_text
+from llm_scheduler import Priority
+
+
+def _summary_prompt(text: str) -> str:
+    return f"Summarize the following information into a concise knowledge base: {text}"
+
+
+def _reduce_prompt(summaries: List[str]) -> str:
+    joined = "\n\n---\n\n".join(summaries)
+    return (
+        "The following are partial summaries of different sections of the same material. "
+        "Merge them into a single concise knowledge base, removing repetition but keeping "
+        f"every distinct fact: {joined}"
+    )
+
+
+async def summarize_documents(model, documents: List[str], use_cache: bool = True,
+                              priority: Priority = Priority.SUMMARIZATION) -> str:
+    """
+    Summarize documents with a map-reduce pipeline.
+
+    Small inputs take a single model call. Larger inputs are split into chunks that are
+    summarized concurrently (bounded by SUMMARY_MAX_CONCURRENCY), then the partial
+    summaries are merged in groups of SUMMARY_REDUCE_FAN_IN until one remains.
+    """
+    chunks = split_into_chunks(documents, settings.SUMMARY_CHUNK_TOKENS)
+    if len(chunks) <= 1:
+        return await generate_text(
+            model, _summary_prompt("\n\n".join(documents)), use_cache=use_cache, priority=priority
+        )
+
+    semaphore = asyncio.Semaphore(settings.SUMMARY_MAX_CONCURRENCY)
+
+    async def run(prompt: str) -> str:
+        async with semaphore:
+            return await generate_text(model, prompt, use_cache=use_cache, priority=priority)
+
+    # Map: summarize every chunk concurrently
+    summaries = await asyncio.gather(*(run(_summary_prompt(chunk)) for chunk in chunks))
+
+    # Reduce: merge partial summaries level by level
+    fan_in = max(2, settings.SUMMARY_REDUCE_FAN_IN)
+    while len(summaries) > 1:
+        groups = [summaries[i:i + fan_in] for i in range(0, len(summaries), fan_in)]
+        summaries = await asyncio.gather(
+            *(run(_reduce_prompt(group)) if len(group) > 1 else _passthrough(group[0]) for group in groups)
+        )
+    return summaries[0]
+
+
+async def _passthrough(summary: str) -> str:
+    return summary
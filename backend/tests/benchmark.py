@@ -0,0 +1,416 @@
+"""
+Offline benchmark for the Dream Line Project API.
+
+Drives /setup-agent/, /chat/, /chat/stream/, /generate-questions/ and /quiz/ in-process
+(no network, no Gemini, no MongoDB): model calls go to a configurable fake model
+and storage is an in-memory mongomock store. Reports p50/p95/p99 latency,
+throughput and memory per scenario and concurrency level, and writes the results
+as JSON so runs can be compared.
+
+How to run (from backend/):
+    python tests/benchmark.py --concurrency 1,8,32 --requests 200 --output bench.json
+    python tests/benchmark.py --compare bench.json --output bench-new.json
+
+Requires mongomock-motor (see requirements-test.txt).
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+# Add backend to path
+backend_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if backend_path not in sys.path:
+    sys.path.insert(0, backend_path)
+
+SCENARIOS = ("setup", "chat", "chat_stream", "questions", "quiz")
+
+
+class _FakeUsage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class _FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _FakeResponse:
+    def __init__(self, text: str, usage: _FakeUsage):
+        self.text = text
+        self.usage_metadata = usage
+
+
+class _FakeStream:
+    """Async-iterable streamed response that yields the output a few tokens at a time"""
+
+    def __init__(self, pieces: List[str], delay: float, usage: _FakeUsage):
+        self._pieces = pieces
+        self._delay = delay
+        self.usage_metadata = usage
+
+    async def __aiter__(self):
+        for piece in self._pieces:
+            await asyncio.sleep(self._delay)
+            yield _FakeChunk(piece)
+
+
+class FakeGeminiModel:
+    """
+    Stand-in for genai.GenerativeModel.
+
+    Latency is log-normal around `latency_ms` (spread `latency_sigma`), streamed
+    responses yield one piece every `stream_chunk_ms`, and a `failure_rate`
+    fraction of calls raises a transient 503 like the real API would.
+    """
+
+    def __init__(self, latency_ms: float = 300, latency_sigma: float = 0.3, failure_rate: float = 0.0,
+                 stream_chunk_ms: float = 20, output_words: int = 120, seed: Optional[int] = None):
+        self.model_name = "models/fake-gemini"
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.stream_chunk_ms = stream_chunk_ms
+        self.output_words = output_words
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+
+    def _latency(self) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        return self._random.lognormvariate(math.log(self.latency_ms / 1000), self.latency_sigma)
+
+    def _maybe_fail(self) -> None:
+        if self._random.random() < self.failure_rate:
+            from google.api_core import exceptions as google_exceptions
+            self.failures += 1
+            raise google_exceptions.ServiceUnavailable("Fake model overloaded")
+
+    def _output(self, prompt: str, generation_config: dict = None) -> str:
+        if generation_config and generation_config.get("response_mime_type") == "application/json":
+            match = re.search(r"exactamente (\d+) preguntas", prompt)
+            count = int(match.group(1)) if match else 5
+            salt = self._random.randrange(1_000_000)
+            return json.dumps([
+                {
+                    "type": "multiple_choice",
+                    "question": f"Pregunta de prueba {salt}-{i + 1}: ¿cuál es la opción correcta?",
+                    "options": ["Opción A", "Opción B", "Opción C", "Opción D"],
+                    "correctAnswer": i % 4,
+                    "explanation": "La opción correcta se deduce del conocimiento del agente.",
+                    "difficulty": "beginner",
+                    "topic": "benchmark",
+                    "xp": 90,
+                }
+                for i in range(count)
+            ], ensure_ascii=False)
+        words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit"]
+        return " ".join(self._random.choice(words) for _ in range(self.output_words))
+
+    def _usage(self, prompt: str, text: str) -> _FakeUsage:
+        return _FakeUsage(max(1, len(prompt) // 4), max(1, len(text) // 4))
+
+    async def generate_content_async(self, prompt: str, stream: bool = False, generation_config: dict = None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self._latency())
+        self._maybe_fail()
+        text = self._output(prompt, generation_config)
+        usage = self._usage(prompt, text)
+        if not stream:
+            return _FakeResponse(text, usage)
+        words = text.split(" ")
+        pieces = [" ".join(words[i:i + 8]) + " " for i in range(0, len(words), 8)]
+        return _FakeStream(pieces, self.stream_chunk_ms / 1000, usage)
+
+    async def count_tokens_async(self, contents):
+        return None
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile (values need not be sorted)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize_run(scenario: str, concurrency: int, latencies: List[float], statuses: List[int],
+                  elapsed: float) -> Dict:
+    ok = [latency for latency, status in zip(latencies, statuses) if 200 <= status < 300]
+    status_counts = {}
+    for status in statuses:
+        status_counts[str(status)] = status_counts.get(str(status), 0) + 1
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(statuses),
+        "ok": len(ok),
+        "errors": len(statuses) - len(ok),
+        "status_counts": status_counts,
+        "latency_ms": {
+            "p50": round(percentile(ok, 50) * 1000, 2),
+            "p95": round(percentile(ok, 95) * 1000, 2),
+            "p99": round(percentile(ok, 99) * 1000, 2),
+            "mean": round(sum(ok) / len(ok) * 1000, 2) if ok else 0.0,
+            "max": round(max(ok) * 1000, 2) if ok else 0.0,
+        },
+        "throughput_rps": round(len(ok) / elapsed, 2) if elapsed > 0 else 0.0,
+        "elapsed_seconds": round(elapsed, 3),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def compare_results(previous: Dict, current: Dict, threshold: float) -> List[str]:
+    """List runs whose p95 latency or throughput regressed by more than `threshold` (fraction)"""
+    before = {(r["scenario"], r["concurrency"]): r for r in previous.get("results", [])}
+    regressions = []
+    for run in current.get("results", []):
+        old = before.get((run["scenario"], run["concurrency"]))
+        if old is None:
+            continue
+        label = f"{run['scenario']} @ {run['concurrency']}"
+        old_p95, new_p95 = old["latency_ms"]["p95"], run["latency_ms"]["p95"]
+        if old_p95 > 0 and new_p95 > old_p95 * (1 + threshold):
+            regressions.append(f"{label}: p95 {old_p95}ms -> {new_p95}ms")
+        old_rps, new_rps = old["throughput_rps"], run["throughput_rps"]
+        if old_rps > 0 and new_rps < old_rps * (1 - threshold):
+            regressions.append(f"{label}: throughput {old_rps} -> {new_rps} req/s")
+    return regressions
+
+
+def _configure_environment(args) -> None:
+    """Settings are read at import time, so they must be in place before the app is imported"""
+    os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+    os.environ.setdefault("MODEL_WARMUP_ENABLED", "False")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("LLM_CACHE_MONGO_ENABLED", "False")
+    if not args.respect_limits:
+        # Measure the service, not the provider quota
+        for name in ("LLM_REQUESTS_PER_MINUTE", "LLM_TOKENS_PER_MINUTE", "LLM_MAX_WAIT_CHAT_SECONDS",
+                     "LLM_MAX_WAIT_QUESTIONS_SECONDS", "LLM_MAX_WAIT_SUMMARIZATION_SECONDS"):
+            os.environ.setdefault(name, "0")
+        os.environ.setdefault("LLM_MAX_CONCURRENT", "1000")
+
+
+def _install_fakes(fake_model: FakeGeminiModel) -> None:
+    """Point every module at the fake model and an in-memory Mongo"""
+    from mongomock_motor import AsyncMongoMockClient
+    import db
+    import gemini_client
+    import main  # Imports every service module, so their collection references can be swapped
+    import agent_cache
+
+    client = AsyncMongoMockClient()
+    store = client[db.settings.DB_NAME]
+    replacements = {
+        id(value): store.get_collection(value.name)
+        for name, value in vars(db).items() if name.endswith("_collection")
+    }
+    for module in list(sys.modules.values()):
+        if getattr(module, "__file__", None) and os.path.dirname(os.path.abspath(module.__file__)) == backend_path:
+            for name, value in list(vars(module).items()):
+                if id(value) in replacements:
+                    setattr(module, name, replacements[id(value)])
+    db.client = client
+    db.db = store
+
+    # mongomock has no change streams; the agent cache falls back to version checks
+    agent_cache.agent_cache.start = lambda: None
+
+    gemini_client.model = fake_model
+    gemini_client.get_model = lambda name: fake_model
+
+
+def _document(index: int, words: int) -> str:
+    rng = random.Random(index)
+    vocabulary = ["fotosíntesis", "clorofila", "energía", "luz", "glucosa", "oxígeno", "planta",
+                  "célula", "agua", "dióxido", "carbono", "hoja", "raíz", "nutrientes", "ciclo"]
+    sentences = []
+    for _ in range(max(1, words // 12)):
+        sentences.append(" ".join(rng.choice(vocabulary) for _ in range(12)).capitalize() + ".")
+    return f"Documento {index}. " + " ".join(sentences)
+
+
+async def _request(client, scenario: str, index: int, agent_id: str, args) -> int:
+    params = {} if args.cache else {"use_cache": "false"}
+    if scenario == "setup":
+        body = {
+            "name": f"Agente {index}",
+            "system_prompt": "Eres un tutor de biología.",
+            "documents": [_document(index, args.document_words)],
+        }
+        response = await client.post("/api/setup-agent/", json=body, params=params)
+    elif scenario == "chat":
+        body = {"user_prompt": f"¿Qué papel cumple la clorofila? ({index % args.distinct_prompts})"}
+        response = await client.post(f"/api/agent/{agent_id}/chat/", json=body, params=params)
+    elif scenario == "chat_stream":
+        body = {"user_prompt": f"Explica la fotosíntesis ({index % args.distinct_prompts})"}
+        async with client.stream("POST", f"/api/agent/{agent_id}/chat/stream/", json=body, params=params) as response:
+            async for _ in response.aiter_bytes():
+                pass
+    elif scenario == "questions":
+        body = {"num_questions": args.num_questions, "user_id": f"user-{index}"}
+        response = await client.post(f"/api/agent/{agent_id}/generate-questions/", json=body, params=params)
+    else:
+        body = {
+            "name": f"Quiz {index}",
+            "system_prompt": "Eres un tutor de biología.",
+            "documents": [_document(index, args.document_words)],
+            "num_questions": args.num_questions,
+        }
+        response = await client.post("/api/quiz/", json=body, params=params)
+    return response.status_code
+
+
+async def run_scenario(client, scenario: str, concurrency: int, agent_id: str, args) -> Dict:
+    latencies: List[float] = []
+    statuses: List[int] = []
+    next_index = iter(range(args.requests))
+
+    async def worker():
+        for index in next_index:
+            started = time.perf_counter()
+            try:
+                status = await _request(client, scenario, index + concurrency * args.requests, agent_id, args)
+            except Exception as e:
+                print(f"❌ {scenario} request failed: {e}")
+                status = 599
+            latencies.append(time.perf_counter() - started)
+            statuses.append(status)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize_run(scenario, concurrency, latencies, statuses, time.perf_counter() - started)
+
+
+async def run_benchmark(args) -> Dict:
+    _configure_environment(args)
+    fake_model = FakeGeminiModel(
+        latency_ms=args.latency_ms, latency_sigma=args.latency_sigma, failure_rate=args.failure_rate,
+        stream_chunk_ms=args.stream_chunk_ms, output_words=args.output_words, seed=args.seed,
+    )
+    _install_fakes(fake_model)
+
+    import httpx
+    from main import app, lifespan
+
+    results = []
+    async with lifespan(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            # One agent shared by the chat and question scenarios
+            response = await client.post("/api/setup-agent/", json={
+                "name": "Agente de referencia",
+                "system_prompt": "Eres un tutor de biología.",
+                "documents": [_document(-1, args.document_words)],
+            })
+            response.raise_for_status()
+            agent_id = response.json()["_id"]
+
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    result = await run_scenario(client, scenario, concurrency, agent_id, args)
+                    latency = result["latency_ms"]
+                    print(f"📊 {scenario:<12} c={concurrency:<4} ok={result['ok']:<5} err={result['errors']:<4} "
+                          f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms "
+                          f"rps={result['throughput_rps']} rss={result['peak_rss_mb']}MB")
+                    results.append(result)
+
+    return {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "fake_model": {
+                "latency_ms": args.latency_ms,
+                "latency_sigma": args.latency_sigma,
+                "failure_rate": args.failure_rate,
+                "stream_chunk_ms": args.stream_chunk_ms,
+                "output_words": args.output_words,
+                "calls": fake_model.calls,
+                "failures": fake_model.failures,
+            },
+            "requests_per_run": args.requests,
+            "cache": args.cache,
+            "respect_limits": args.respect_limits,
+        },
+        "results": results,
+    }
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark with a fake Gemini model and in-memory Mongo")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda value: [s for s in value.split(",") if s],
+                        help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", type=lambda value: [int(c) for c in value.split(",")],
+                        help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario and concurrency level")
+    parser.add_argument("--latency-ms", type=float, default=300, help="Median fake model latency")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="Log-normal spread of the latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of model calls that fail with 503")
+    parser.add_argument("--stream-chunk-ms", type=float, default=20, help="Delay between streamed chunks")
+    parser.add_argument("--output-words", type=int, default=120, help="Words per fake text response")
+    parser.add_argument("--document-words", type=int, default=2000, help="Words per uploaded document")
+    parser.add_argument("--num-questions", type=int, default=5, help="Questions per /generate-questions/ and /quiz/ call")
+    parser.add_argument("--distinct-prompts", type=int, default=1000, help="Distinct chat prompts (lower = more cache hits)")
+    parser.add_argument("--cache", action=argparse.BooleanOptionalAction, default=True, help="Use the LLM response cache")
+    parser.add_argument("--respect-limits", action="store_true", help="Keep the configured RPM/TPM limits")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the fake model")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    parser.add_argument("--regression-threshold", type=float, default=0.10,
+                        help="Relative p95/throughput change reported as a regression")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None) -> int:
+    args = _parse_args(argv)
+    print("🧪 Dream Line Project - Offline Benchmark")
+    print("=" * 60)
+    report = asyncio.run(run_benchmark(args))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"💾 Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous = json.load(f)
+        regressions = compare_results(previous, report, args.regression_threshold)
+        if regressions:
+            print("⚠️  Regressions:")
+            for line in regressions:
+                print(f"   {line}")
+            return 1
+        print("✅ No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,28 @@
+"""
+Shared fixtures for the backend test suite
+"""
+
+import pytest
+
+from backend.models import Question
+
+
+@pytest.fixture
+def mongo_db():
+    """A fresh in-memory Mongo database; take collections from it by name"""
+    from mongomock_motor import AsyncMongoMockClient
+    return AsyncMongoMockClient()["test_db"]
+
+
+@pytest.fixture
+def make_question():
+    """Factory for valid multiple-choice questions; keyword arguments override any field"""
+    def make(text="¿Pregunta?", **fields):
+        values = {
+            "id": "tmp", "type": "multiple_choice", "question": text,
+            "options": ["a", "b", "c", "d"], "correctAnswer": 0, "explanation": "e",
+            "difficulty": "beginner", "topic": "t", "xp": 90,
+        }
+        values.update(fields)
+        return Question(**values)
+    return make
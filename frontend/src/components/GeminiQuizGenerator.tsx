@@ -63,8 +63,8 @@ export function GeminiQuizGenerator() {
 
     setIsGenerating(true);
     try {
-      const questions = await generateQuestionsWithGemini(topic, content);
-      startQuizSession(topic, questions);
+      const { questions, sessionId } = await generateQuestionsWithGemini(topic, content);
+      startQuizSession(topic, questions, sessionId);
       setTopic('');
       setContent('');
       setFileName(null);
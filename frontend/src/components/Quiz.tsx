@@ -5,15 +5,18 @@ import { Badge } from '@/components/ui/badge';
 import { Progress } from '@/components/ui/progress';
 import { CheckCircle, XCircle, ArrowRight, RotateCcw, Trophy } from 'lucide-react';
 import { useAppContext } from '../context/AppContext';
-import { submitAnswer } from '../utils/api';
+import { gradeLocalAnswer, gradeQuiz } from '../utils/api';
 import { toast } from '@/hooks/use-toast';
 
 export function Quiz() {
   const { state, updateQuizSession, endQuizSession, updateUserXP } = useAppContext();
   const [selectedAnswer, setSelectedAnswer] = useState('');
   const [showFeedback, setShowFeedback] = useState(false);
-  const [feedback, setFeedback] = useState<{ isCorrect: boolean; feedback: string; xpEarned: number } | null>(null);
+  const [feedback, setFeedback] = useState<{ isCorrect: boolean; feedback: string; xpEarned: number; explanation?: string } | null>(null);
   const [isSubmitting, setIsSubmitting] = useState(false);
+  // Respuestas de un quiz generado por la API, enviadas juntas al servidor al terminar
+  const [answers, setAnswers] = useState<Record<string, number>>({});
+  const [gradedQuiz, setGradedQuiz] = useState<Awaited<ReturnType<typeof gradeQuiz>> | null>(null);
 
   const session = state.currentQuizSession;
   
@@ -33,6 +36,31 @@ export function Quiz() {
     }
   };
 
+  // Las preguntas generadas por la API se califican en el servidor, que otorga la XP una sola vez:
+  // se guarda cada respuesta y el quiz completo se califica con una sola petición al final
+  const submitServerAnswer = async (gradingSessionId: string) => {
+    const collected = {
+      ...answers,
+      [currentQuestion.id]: currentQuestion.options?.indexOf(selectedAnswer) ?? -1,
+    };
+    setAnswers(collected);
+    if (!isLastQuestion) {
+      goToNextQuestion();
+      return;
+    }
+
+    const graded = await gradeQuiz(
+      gradingSessionId,
+      Object.entries(collected).map(([question_id, answer]) => ({ question_id, answer })),
+      state.user?.id
+    );
+    if (graded.xp_earned > 0) {
+      updateUserXP(graded.xp_earned);
+      updateQuizSession({ score: session.score + graded.xp_earned });
+    }
+    setGradedQuiz(graded);
+  };
+
   const handleSubmitAnswer = async () => {
     if (!selectedAnswer) {
       toast({
@@ -45,11 +73,15 @@ export function Quiz() {
 
     setIsSubmitting(true);
     try {
-      const result = await submitAnswer(currentQuestion.id, selectedAnswer, currentQuestion.correctAnswer);
+      if (session.gradingSessionId) {
+        await submitServerAnswer(session.gradingSessionId);
+        return;
+      }
+      const result = gradeLocalAnswer(selectedAnswer, currentQuestion.correctAnswer ?? '');
       setFeedback(result);
       setShowFeedback(true);
       
-      if (result.isCorrect) {
+      if (result.isCorrect && result.xpEarned > 0) {
         updateUserXP(result.xpEarned);
         updateQuizSession({ 
           score: session.score + result.xpEarned 
@@ -66,26 +98,34 @@ export function Quiz() {
     }
   };
 
+  const finishQuiz = () => {
+    updateQuizSession({ 
+      isCompleted: true,
+      completedAt: new Date().toISOString()
+    });
+    toast({
+      title: "¡Quiz completado!",
+      description: `Obtuviste ${session.score} puntos en total.`,
+    });
+    endQuizSession();
+  };
+
+  const goToNextQuestion = () => {
+    updateQuizSession({ 
+      currentQuestionIndex: session.currentQuestionIndex + 1 
+    });
+    setSelectedAnswer('');
+    setShowFeedback(false);
+    setFeedback(null);
+  };
+
   const handleNext = () => {
     if (isLastQuestion) {
       // Completar quiz
-      updateQuizSession({ 
-        isCompleted: true,
-        completedAt: new Date().toISOString()
-      });
-      toast({
-        title: "¡Quiz completado!",
-        description: `Obtuviste ${session.score} puntos en total.`,
-      });
-      endQuizSession();
+      finishQuiz();
     } else {
       // Siguiente pregunta
-      updateQuizSession({ 
-        currentQuestionIndex: session.currentQuestionIndex + 1 
-      });
-      setSelectedAnswer('');
-      setShowFeedback(false);
-      setFeedback(null);
+      goToNextQuestion();
     }
   };
 
@@ -95,6 +135,77 @@ export function Quiz() {
     setFeedback(null);
   };
 
+  if (gradedQuiz) {
+    // Resultados del quiz calificado en el servidor
+    return (
+      <div className="max-w-4xl mx-auto space-y-4 sm:space-y-6 px-4">
+        <Card className="bg-gradient-to-r from-blue-500 to-purple-600 text-white">
+          <CardHeader>
+            <div className="flex flex-col sm:flex-row items-start sm:items-center justify-between gap-4">
+              <div>
+                <CardTitle className="text-xl sm:text-2xl">Quiz: {session.topic}</CardTitle>
+                <p className="text-blue-100 text-sm sm:text-base">
+                  {gradedQuiz.correct} de {gradedQuiz.total} respuestas correctas
+                </p>
+              </div>
+              <div className="text-left sm:text-right w-full sm:w-auto">
+                <div className="text-xl sm:text-2xl font-bold">{session.score}</div>
+                <div className="text-xs sm:text-sm text-blue-100">puntos</div>
+              </div>
+            </div>
+          </CardHeader>
+        </Card>
+
+        {gradedQuiz.results.map((result) => {
+          const question = session.questions.find((q) => q.id === result.question_id);
+          const correctText = question?.options?.[result.correctAnswer];
+          return (
+            <Card
+              key={result.question_id}
+              className={`border-2 ${result.correct ? 'bg-green-50 border-green-200' : 'bg-red-50 border-red-200'}`}
+            >
+              <CardContent className="pt-6 space-y-3">
+                <div className="flex items-center space-x-3">
+                  {result.correct ? (
+                    <CheckCircle className="h-6 w-6 text-green-600 shrink-0" />
+                  ) : (
+                    <XCircle className="h-6 w-6 text-red-600 shrink-0" />
+                  )}
+                  <span className="font-semibold text-sm sm:text-base text-gray-800">{question?.question}</span>
+                  {result.xp_earned > 0 && (
+                    <Badge className="bg-green-500">
+                      +{result.xp_earned} XP
+                    </Badge>
+                  )}
+                </div>
+                {!result.correct && (
+                  <p className="text-sm sm:text-base text-red-700">
+                    La respuesta correcta es: "{correctText}"
+                  </p>
+                )}
+                <div className="p-4 bg-white rounded border">
+                  <p className="text-sm text-gray-600 font-medium">Explicación:</p>
+                  <p className="text-sm sm:text-base text-gray-700 mt-1">{result.explanation || correctText}</p>
+                </div>
+              </CardContent>
+            </Card>
+          );
+        })}
+
+        <div className="flex justify-center sm:justify-end">
+          <Button 
+            onClick={finishQuiz}
+            className="bg-green-500 hover:bg-green-600 w-full sm:w-auto px-6 sm:px-8"
+            size="lg"
+          >
+            <Trophy className="h-4 w-4 mr-2" />
+            Finalizar Quiz
+          </Button>
+        </div>
+      </div>
+    );
+  }
+
   return (
     <div className="max-w-4xl mx-auto space-y-4 sm:space-y-6 px-4">
       {/* Header del Quiz */}
@@ -268,7 +379,7 @@ export function Quiz() {
                   className="bg-blue-500 hover:bg-blue-600 px-6 sm:px-8 w-full sm:w-auto"
                   size="lg"
                 >
-                  {isSubmitting ? 'Enviando...' : 'Enviar respuesta'}
+                  {isSubmitting ? 'Enviando...' : session.gradingSessionId && !isLastQuestion ? 'Guardar y continuar' : 'Enviar respuesta'}
                 </Button>
               </div>
             </div>
@@ -291,7 +402,7 @@ export function Quiz() {
                   }`}>
                     {feedback?.isCorrect ? '¡Correcto!' : 'Incorrecto'}
                   </span>
-                  {feedback?.isCorrect && (
+                  {feedback?.isCorrect && feedback.xpEarned > 0 && (
                     <Badge className="bg-green-500">
                       +{feedback.xpEarned} XP
                     </Badge>
@@ -304,7 +415,7 @@ export function Quiz() {
                 </p>
                 <div className="mt-4 p-4 bg-white rounded border">
                   <p className="text-sm text-gray-600 font-medium">Explicación:</p>
-                  <p className="text-sm sm:text-base text-gray-700 mt-1">{currentQuestion.explanation}</p>
+                  <p className="text-sm sm:text-base text-gray-700 mt-1">{feedback?.explanation ?? currentQuestion.explanation}</p>
                 </div>
               </div>
 
@@ -82,7 +82,7 @@ interface AppContextType {
   dispatch: React.Dispatch<AppAction>;
   updateUserXP: (xp: number) => void;
   completeLesson: (lessonId: string) => void;
-  startQuizSession: (topic: string, questions: Question[]) => void;
+  startQuizSession: (topic: string, questions: Question[], gradingSessionId?: string) => void;
   updateQuizSession: (updates: Partial<QuizSession>) => void;
   endQuizSession: () => void;
   setUser: (user: User | null) => void;
@@ -144,11 +144,12 @@ export function AppProvider({ children }: { children: React.ReactNode }) {
     dispatch({ type: 'COMPLETE_LESSON', payload: lessonId });
   };
 
-  const startQuizSession = (topic: string, questions: Question[]) => {
+  const startQuizSession = (topic: string, questions: Question[], gradingSessionId?: string) => {
     const session: QuizSession = {
       id: Date.now().toString(),
       topic,
       questions,
+      gradingSessionId,
       currentQuestionIndex: 0,
       score: 0,
       isCompleted: false,
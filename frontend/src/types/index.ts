@@ -24,8 +24,9 @@ export interface Question {
   type: 'multiple_choice' | 'code_completion' | 'debugging' | 'coding_task';
   question: string;
   options?: string[];
-  correctAnswer: string;
-  explanation: string;
+  // Solo en las preguntas locales; las generadas por la API se califican en el servidor
+  correctAnswer?: string;
+  explanation?: string;
   difficulty: 'beginner' | 'intermediate' | 'advanced';
   topic: string;
   xp: number;
@@ -58,6 +59,7 @@ export interface QuizSession {
   id: string;
   topic: string;
   questions: Question[];
+  gradingSessionId?: string; // Sesión de calificación del servidor (quizzes generados por la API)
   currentQuestionIndex: number;
   score: number;
   isCompleted: boolean;
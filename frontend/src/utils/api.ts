@@ -86,17 +86,20 @@ export async function generateQuestions(topic: string): Promise<Question[]> {
 }
 
 // AI Agent question generator (reemplaza Gemini)
-export async function generateQuestionsWithGemini(topic: string, content?: string): Promise<Question[]> {
+export async function generateQuestionsWithGemini(topic: string, content?: string): Promise<{
+  questions: Question[];
+  sessionId: string;
+}> {
   // Validar que se haya proporcionado contenido del documento
   if (!content) {
     throw new Error("El documento de referencia es obligatorio para generar preguntas con IA.");
   }
 
   try {
-    // Paso 1: Setup del agente
-    console.log("Configurando agente con:", { topic, documentLength: content.length });
+    // Un solo paso: el servidor crea el agente y genera las preguntas en paralelo
+    console.log("Creando quiz con:", { topic, documentLength: content.length });
     
-    const setupResponse = await fetch('http://localhost:8000/api/setup-agent/', {
+    const quizResponse = await fetch('http://localhost:8000/api/quiz/', {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
@@ -104,71 +107,36 @@ export async function generateQuestionsWithGemini(topic: string, content?: strin
       body: JSON.stringify({
         name: topic,
         system_prompt: `You are a helpful assistant that specializes in ${topic}`,
-        documents: [content]
-      })
-    });
-
-    if (!setupResponse.ok) {
-      throw new Error(`Error al configurar el agente: ${setupResponse.status} ${setupResponse.statusText}`);
-    }
-
-    const setupData = await setupResponse.json();
-    console.log("Agente configurado:", setupData);
-
-    const agentId = setupData._id;
-    // const knowledgeSummary = setupData.knowledge_summary; // Guardado para uso futuro
-
-    if (!agentId) {
-      throw new Error("No se recibió un ID válido del agente.");
-    }
-
-    // Paso 2: Generar preguntas usando el agente
-    console.log("Generando preguntas con agente ID:", agentId);
-    
-    const questionsResponse = await fetch(`http://localhost:8000/api/agent/${agentId}/generate-questions`, {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({
+        documents: [content],
         num_questions: 5,
         difficulty: "advanced"
       })
     });
 
-    if (!questionsResponse.ok) {
-      throw new Error(`Error al generar preguntas: ${questionsResponse.status} ${questionsResponse.statusText}`);
+    if (!quizResponse.ok) {
+      throw new Error(`Error al generar el quiz: ${quizResponse.status} ${quizResponse.statusText}`);
     }
 
-    const questionsData = await questionsResponse.json();
+    const quizData = await quizResponse.json();
+    console.log("Agente configurado:", quizData.agent);
+
+    const questionsData = quizData.questions;
     console.log("Preguntas generadas por la API:", questionsData);
 
-    // Transformar las preguntas al formato esperado
-    const transformedQuestions: Question[] = questionsData.map((q: any, index: number) => {
-      const correctAnswerText = q.options[q.correctAnswer]; // Obtener el texto de la respuesta correcta usando el índice
-      console.log(`Pregunta ${index + 1}:`, {
-        originalCorrectAnswer: q.correctAnswer,
-        correctAnswerText,
-        options: q.options,
-        explanation: q.explanation
-      });
-      
-      return {
-        id: q.id,
-        type: q.type,
-        question: q.question,
-        options: q.options,
-        correctAnswer: correctAnswerText, // Usar el texto de la respuesta correcta
-        explanation: q.explanation || correctAnswerText, // Si la explicación está vacía, usar la respuesta correcta
-        difficulty: q.difficulty,
-        topic: q.topic,
-        xp: q.xp
-      };
-    });
+    // Las preguntas llegan sin la respuesta correcta: se califican con gradeQuiz
+    const transformedQuestions: Question[] = questionsData.map((q: any) => ({
+      id: q.id,
+      type: q.type,
+      question: q.question,
+      options: q.options,
+      difficulty: q.difficulty,
+      topic: q.topic,
+      xp: q.xp
+    }));
 
     console.log("Preguntas transformadas:", transformedQuestions);
 
-    return transformedQuestions;
+    return { questions: transformedQuestions, sessionId: quizData.session_id };
 
   } catch (error) {
     console.error('Error conectando con la API local:', error);
@@ -178,17 +146,15 @@ export async function generateQuestionsWithGemini(topic: string, content?: strin
   }
 }
 
-export async function submitAnswer(questionId: string, answer: string, correctAnswer: string): Promise<{
+/**
+ * Califica localmente una pregunta de las lecciones incluidas en la app
+ * (las preguntas generadas por la API se califican con gradeQuiz)
+ */
+export function gradeLocalAnswer(answer: string, correctAnswer: string): {
   isCorrect: boolean;
   feedback: string;
   xpEarned: number;
-}> {
-  // Simulate API delay
-  await new Promise(resolve => setTimeout(resolve, 500));
-  
-  // Validar la respuesta comparando con la respuesta correcta
-  console.log('Validando respuesta:', { questionId, answer, correctAnswer });
-  
+} {
   const isCorrect = answer === correctAnswer;
   
   return {
@@ -198,4 +164,40 @@ export async function submitAnswer(questionId: string, answer: string, correctAn
       : `No es correcto. La respuesta correcta es: "${correctAnswer}". Revisa el concepto e inténtalo de nuevo.`,
     xpEarned: isCorrect ? 50 : 10,
   };
-}
\ No newline at end of file
+}
+
+export interface GradedAnswer {
+  question_id: string;
+  correct: boolean;
+  correctAnswer: number;
+  explanation: string;
+  xp_earned: number;
+  already_graded: boolean;
+}
+
+/**
+ * Califica todas las respuestas de un quiz en el servidor con una sola petición
+ * @param sessionId ID de sesión devuelto al generar el quiz
+ * @param answers Índice de la opción elegida por cada pregunta
+ * @returns Resultado por pregunta y XP total ganado
+ */
+export async function gradeQuiz(sessionId: string, answers: { question_id: string; answer: number }[], userId?: string): Promise<{
+  results: GradedAnswer[];
+  correct: number;
+  total: number;
+  xp_earned: number;
+}> {
+  const response = await fetch(`http://localhost:8000/api/quiz/${sessionId}/grade/`, {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/json',
+    },
+    body: JSON.stringify({ answers, user_id: userId })
+  });
+
+  if (!response.ok) {
+    throw new Error(`Error al calificar el quiz: ${response.status} ${response.statusText}`);
+  }
+
+  return response.json();
+}